@@ -4,39 +4,67 @@ if __name__ == '__main__':
 
 	import urwid
 	import urmpd
+	import cache
 	import signals
+	import util
 	from ui_main import MainFrame
 	import configuration
 	from configuration import config
 
+	defaults = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	                        'urmpc.conf.example')
 	config_file = os.path.expanduser('~')
 	if config_file != '~':
 		config_file = os.path.join(config_file, '.urmpc.conf')
 		if not os.path.isfile(config_file):
 			config_file = os.path.join(os.environ.get('HOME', ''), '.urmpc.conf')
 			if not os.path.isfile(config_file):
-				config_file = os.path.join('urmpclib', 'urmpc.conf.example')
+				config_file = defaults
 				if not os.path.isfile(config_file):
 					raise IOError('Configuration file not found.')
 
-	config.read(config_file)
+	# Options an older configuration file lacks take the example's values.
+	config.read([defaults, config_file])
 	palette = configuration.extract_palette(config, 'palette')
 	mpc = urmpd.MPDClient()
-	mpc.connect(config.mpd.host, int(config.mpd.port))
+	mpc.connect(config.mpd.host, int(config.mpd.port), float(config.mpd.timeout))
 	event_loop = urwid.SelectEventLoop()
 
 	# Get urwid set up
 	#FIXME: Passing None in here is ugly and will eventually break if urwid decides
 	#       to be more strict about it.
-	loop = urwid.MainLoop(None, palette, event_loop=event_loop)
+	loop = util.MainLoop(None, palette, event_loop=event_loop,
+	                      max_fps=float(config.format.max_fps))
 	signals._mainloop = loop
 
+	# Background requests are answered through the main loop, so only now.
+	# Everything loads through them; should their answers not come back,
+	# the request times out and says so instead of leaving placeholders.
+	mpc.request('ping', errback=lambda e: signals.emit('user_notification',
+	            'MPD does not answer in the background: %s' % e, 10.0))
+	mpc.enable_cache(cache.LRUCache(int(config.library.cache_entries),
+	                                int(config.library.cache_size) * 1024 * 1024))
+
+	# Start out with the library as we last saw it, if we did.
+	snapshot = None
+	if config.library.snapshot:
+		directory = os.path.expanduser(config.library.snapshot)
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+		except OSError as e:
+			pass # Nowhere to keep it, so every start is from scratch.
+		else:
+			name = '%s_%s.snapshot' % (config.mpd.host, config.mpd.port)
+			snapshot = os.path.join(directory, name.replace(os.sep, '_'))
+			mpc.load_cache(snapshot)
+
 	# Main widget uses mpd
 	frame = MainFrame(mpc)
 	loop.widget = frame
 
-	# Idler runs cloned mpc connection, uses MainLoop to force redraw on MPD events
-	idler = urmpd.Idler(mpc, loop)
+	# Idler runs cloned mpc connection, redraws on MPD events
+	idler = urmpd.Idler(mpc)
 	event_loop.watch_file(idler, idler)
 
 	try:
@@ -44,3 +72,6 @@ if __name__ == '__main__':
 	except KeyboardInterrupt as e:
 		pass
 
+	if snapshot is not None:
+		mpc.save_cache(snapshot)
+
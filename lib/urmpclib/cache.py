@@ -0,0 +1,95 @@
+import sys
+import collections
+
+def sizeof(obj):
+	"""Rough number of bytes held by obj, following lists, tuples, dicts and
+	__slots__. Shared objects are counted every time they are seen; this is
+	meant for budgeting caches, not for exact accounting."""
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		for k, v in obj.iteritems():
+			size += sizeof(k) + sizeof(v)
+	elif isinstance(obj, (list, tuple)):
+		for v in obj:
+			size += sizeof(v)
+	elif hasattr(obj, '__slots__'):
+		for k in obj.__slots__:
+			size += sizeof(getattr(obj, k, None))
+	return size
+
+class LRUCache(object):
+	"""Mapping that forgets the least recently used entries.
+
+	It is bounded by number of entries and/or by approximate size in bytes
+	(see sizeof()), whichever limit is hit first. None means no limit.
+	hits, misses and evictions are counted for the curious."""
+	hits = 0
+	misses = 0
+	evictions = 0
+
+	def __init__(self, max_entries=None, max_bytes=None, sizeof=sizeof):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.size = 0 # Bytes, only tracked if max_bytes is set.
+		self._sizeof = sizeof
+		self._data = collections.OrderedDict() # {key: (value, size)}
+
+	def __len__(self):
+		return len(self._data)
+
+	def __contains__(self, key):
+		"""Doesn't count as a use."""
+		return key in self._data
+
+	def get(self, key, default=None):
+		try:
+			entry = self._data.pop(key)
+		except KeyError as e:
+			self.misses += 1
+			return default
+		self._data[key] = entry # Most recently used go last.
+		self.hits += 1
+		return entry[0]
+
+	def __setitem__(self, key, value):
+		size = 0
+		if self.max_bytes is not None:
+			size = self._sizeof(value)
+		self.pop(key)
+		self._data[key] = value, size
+		self.size += size
+		self._shrink()
+
+	def pop(self, key, default=None):
+		try:
+			value, size = self._data.pop(key)
+		except KeyError as e:
+			return default
+		self.size -= size
+		return value
+
+	def clear(self):
+		self._data.clear()
+		self.size = 0
+
+	def items(self):
+		"""(key, value) pairs, least recently used first."""
+		return [(k, v[0]) for k, v in self._data.iteritems()]
+
+	def stats(self):
+		return {
+			'entries': len(self._data),
+			'bytes': self.size,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+	def _shrink(self):
+		data = self._data
+		while data and (
+				self.max_entries is not None and len(data) > self.max_entries or
+				self.max_bytes is not None and self.size > self.max_bytes):
+			key, (value, size) = data.popitem(last=False)
+			self.size -= size
+			self.evictions += 1
@@ -0,0 +1,145 @@
+"""In-memory copy of the artist -> album -> track tree, filled ahead of time
+so the library columns can read from memory instead of asking MPD."""
+
+import signals
+import cache
+from song import Song
+from configuration import config
+
+# listallinfo entries per streamed batch, small enough to keep the UI going.
+_chunk = 500
+
+def _values(song, tag):
+	"""Tag values of a song; multiple tags come back from MPD as a list."""
+	value = song.get(tag, '')
+	if isinstance(value, list):
+		return value
+	return [value]
+
+class LibraryModel(object):
+	"""Knows some or all of {artist: {album: [Song]}}.
+
+	Artists are filled in one of two ways, as configured by library.prefetch:
+	"all" loads the whole library with a single streamed listallinfo, once
+	start() says the artists are on screen; a number N loads the N artists
+	on either side of the focus with one find each, as the focus moves, and
+	forgets those that end up more than 2N away.
+	Either way this goes over the prefetch connection, see MPDClient.request,
+	so what is on screen never waits for it.
+	While loading everything, each batch of songs is also emitted as
+	'library_songs', and [] once the library is complete, so others can
+	build on them without asking MPD again; see search.SearchIndex.
+	Anything not known yet is None, and callers should ask MPD themselves."""
+	complete = False # Whether every artist is known.
+	_focus = None # (sorted artists, index of focused one)
+	_next = None # Tree being loaded by listallinfo, and its song count.
+
+	def __init__(self, mpc):
+		self.mpc = mpc
+		self._tree = {}
+		self._requests = {} # {artist or None for everything: Request}
+		prefetch = config.library.prefetch
+		self.everything = prefetch == 'all'
+		self._window = 0 if self.everything else int(prefetch)
+		signals.listen('idle_database', self._database_changed)
+
+	def artists(self):
+		if not self.complete:
+			return None
+		return self._tree.keys()
+
+	def albums(self, artist):
+		albums = self._tree.get(artist)
+		if albums is None:
+			return None
+		return albums.keys()
+
+	def tracks(self, artist, album):
+		albums = self._tree.get(artist)
+		if albums is None:
+			return None
+		return albums.get(album, [])
+
+	def memory(self):
+		"""Approximate bytes held by the tree."""
+		return cache.sizeof(self._tree)
+
+	def start(self):
+		"""Starts loading everything, if so configured and not done or under
+		way. Call once the artists are loaded, which matter more."""
+		if self.everything and not self.complete and None not in self._requests:
+			self._next = {}, 0
+			self._requests[None] = self.mpc.request('listallinfo',
+			                                        callback=self._all_arrived,
+			                                        timeout=0, stream=_chunk,
+			                                        prefetch=True)
+
+	def set_focus(self, artists, focus):
+		"""Remembers where the artist column is, for prefetch()."""
+		self._focus = artists, focus
+
+	def prefetch(self):
+		"""Loads the artists around the last focus that aren't known yet and
+		gives up on pending ones that fell out of that window. Artists twice
+		as far away are forgotten, so the tree stays small."""
+		if self._window <= 0 or self._focus is None:
+			return
+		artists, focus = self._focus
+		start = max(focus - self._window, 0)
+		wanted = artists[start:focus + self._window + 1]
+		for artist, request in self._requests.items():
+			if artist not in wanted:
+				request.cancel()
+				del self._requests[artist]
+		start = max(focus - 2 * self._window, 0)
+		keep = set(artists[start:focus + 2 * self._window + 1])
+		for artist in self._tree.keys():
+			if artist not in keep:
+				del self._tree[artist]
+		for artist in wanted:
+			if artist in self._tree or artist in self._requests:
+				continue
+			callback = lambda songs, artist=artist: self._artist_loaded(artist, songs)
+			self._requests[artist] = self.mpc.request('find', 'artist', artist,
+			                                          callback=callback,
+			                                          prefetch=True)
+
+	def _artist_loaded(self, artist, songs):
+		del self._requests[artist]
+		albums = self._tree[artist] = {}
+		for song in songs:
+			song = Song(song)
+			for album in _values(song, 'album'):
+				albums.setdefault(album, []).append(song)
+
+	def _all_arrived(self, entries):
+		"""Adds a batch of listallinfo to the tree, which is used once all of
+		it is there; a batch at a time keeps the UI going meanwhile."""
+		tree, count = self._next
+		if not entries:
+			del self._requests[None]
+			self._next = None
+			self._tree = tree
+			self.complete = True
+			signals.emit('user_notification', 'Library loaded: %d songs' % count)
+			signals.emit('library_songs', [])
+			return
+		songs = [Song(entry) for entry in entries
+		         if 'file' in entry] # Not a directory or playlist.
+		for song in songs:
+			for artist in _values(song, 'artist'):
+				albums = tree.setdefault(artist, {})
+				for album in _values(song, 'album'):
+					albums.setdefault(album, []).append(song)
+		self._next = tree, count + len(songs)
+		if songs:
+			signals.emit('library_songs', songs)
+
+	def _database_changed(self):
+		for request in self._requests.values():
+			request.cancel()
+		self._requests = {}
+		self._tree = {}
+		self._next = None
+		self.complete = False
+		# The artist column reloads too, and calls start() again.
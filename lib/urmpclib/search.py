@@ -0,0 +1,336 @@
+"""Client-side search over the whole library, see SearchIndex."""
+
+import array
+
+import signals
+from song import Song
+
+# listallinfo entries per streamed batch, small enough to keep the UI going.
+_chunk = 500
+# Songs per block. Bigger blocks index faster, smaller ones are skipped more.
+_block = 32
+
+def _values(song, tag):
+	"""Tag values of a song; multiple tags come back from MPD as a list."""
+	value = song.get(tag)
+	if value is None:
+		return []
+	if isinstance(value, list):
+		return value
+	return [value]
+
+def fold(text):
+	"""Returns text as it is searched: lower case, as UTF-8."""
+	if isinstance(text, str):
+		text = text.decode('utf-8', 'replace')
+	return text.lower().encode('utf-8')
+
+def trigrams(text):
+	return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+class _Index(object):
+	"""Songs in blocks of _block, each block's folded tags in one string.
+
+	A trigram maps to the blocks containing it, so looking up a word only
+	scans the blocks having all of its trigrams, with str.find. File names
+	are indexed by path component, hence words are split at slashes too."""
+
+	def __init__(self):
+		self.songs = []
+		self.texts = [] # One per block: a line of tab separated tags per song.
+		self.starts = [] # Per block: where each song's line starts in text.
+		self.grams = {} # {trigram: array of blocks}
+		self._lines = [] # Lines of songs not in a block yet.
+
+	def add(self, song):
+		fields = [value for tag in ('artist', 'album', 'title')
+		          for value in _values(song, tag)]
+		fields.append(song.file)
+		self.songs.append(song)
+		# Words never hold whitespace, so tabs and newlines keep them apart.
+		self._lines.append(fold('\t'.join(fields).replace('\n', ' ')))
+		if len(self._lines) == _block:
+			self.flush()
+
+	def flush(self):
+		"""Makes the songs added since the last block a block of their own."""
+		lines = self._lines
+		if not lines:
+			return
+		self._lines = []
+		block = len(self.texts)
+		starts = array.array('i')
+		offset = 0
+		strings = set()
+		for line in lines:
+			starts.append(offset)
+			offset += len(line) + 1
+			strings.update(line.replace('/', '\t').split('\t'))
+		self.texts.append('\n'.join(lines))
+		self.starts.append(starts)
+		grams = set()
+		for string in strings:
+			grams.update(trigrams(string))
+		for gram in grams:
+			blocks = self.grams.get(gram)
+			if blocks is None:
+				blocks = self.grams[gram] = array.array('i')
+			blocks.append(block)
+
+	def blocks(self, words):
+		"""Blocks that may hold songs having all words, in order."""
+		grams = set()
+		for word in words:
+			for piece in word.split('/'):
+				grams.update(trigrams(piece))
+		if not grams:
+			return xrange(len(self.texts))
+		postings = []
+		for gram in grams:
+			blocks = self.grams.get(gram)
+			if blocks is None:
+				return []
+			postings.append(blocks)
+		postings.sort(key=len)
+		blocks = set(postings[0])
+		for other in postings[1:]:
+			blocks.intersection_update(other)
+			if not blocks:
+				return []
+		return sorted(blocks)
+
+	def matches(self, words):
+		"""Yields positions in self.songs of songs having all words, in order.
+		The first word is the one scanned for, the others only checked."""
+		first, others = words[0], words[1:]
+		for block in self.blocks(words):
+			text = self.texts[block]
+			if others and not all(word in text for word in others):
+				continue
+			starts = self.starts[block]
+			base = block * _block
+			song = -1
+			at = text.find(first)
+			while at >= 0:
+				# Songs are few per block; a linear walk beats bisect here.
+				while song + 1 < len(starts) and starts[song + 1] <= at:
+					song += 1
+				end = text.find('\n', at)
+				line = text[starts[song]:end if end >= 0 else len(text)]
+				if all(word in line for word in others):
+					yield base + song
+				if end < 0:
+					break
+				at = text.find(first, end)
+
+class Results(object):
+	"""Songs found by SearchIndex.search(), looked for only as far as they
+	are looked at: a list of results scans no further than what is shown.
+	len() finds all of them."""
+
+	def __init__(self, songs, positions):
+		self._songs = songs
+		self._positions = positions # Iterator, None once exhausted.
+		self._found = []
+
+	@property
+	def found(self):
+		"""How many songs were found so far."""
+		return len(self._found)
+
+	@property
+	def complete(self):
+		"""Whether all songs were found."""
+		return self._positions is None
+
+	def __getitem__(self, pos):
+		if pos < 0:
+			raise IndexError(pos)
+		self._find(pos + 1)
+		return self._songs[self._found[pos]]
+
+	def __len__(self):
+		self._find()
+		return len(self._found)
+
+	def __iter__(self):
+		pos = 0
+		while True:
+			try:
+				yield self[pos]
+			except IndexError as e:
+				return
+			pos += 1
+
+	def index(self, song):
+		for pos, other in enumerate(self):
+			if other is song:
+				return pos
+		raise ValueError(song)
+
+	def _find(self, count=None):
+		"""Finds songs until there are count, or all of them."""
+		found = self._found
+		while self._positions is not None and (count is None or len(found) < count):
+			try:
+				found.append(next(self._positions))
+			except StopIteration as e:
+				self._positions = None
+
+class SearchIndex(object):
+	"""Finds songs by words in their artist, album, title or file name.
+	Every word must occur in one of those, case doesn't matter.
+
+	Built from a single listallinfo, streamed so the UI keeps going while it
+	arrives, or from the songs a LibraryModel loading everything emits, so
+	the library isn't sent twice. When the database changes the index is
+	built anew in the background and searches keep using the old one until
+	then. 'search_index_changed' is emitted whenever search results might
+	differ."""
+	complete = False # Whether search() covers the whole library.
+	_request = None
+
+	def __init__(self, mpc, model=None):
+		"""model: the library.LibraryModel, if there is one."""
+		self.mpc = mpc
+		self._index = _Index() # Searched.
+		self._next = None # Being built.
+		self._shared = model is not None and model.everything
+		signals.listen('idle_database', self._database_changed)
+		if self._shared:
+			signals.listen('library_songs', self._songs_arrived)
+
+	@property
+	def songs(self):
+		"""Song objects; positions in here are what search() returns."""
+		return self._index.songs
+
+	def load(self):
+		"""Starts building the index unless it is built or on its way.
+		A shared index is built as the library loads, asked for or not."""
+		if self._shared or self.complete or self._request is not None:
+			return
+		self._begin()
+		self._request = self.mpc.request('listallinfo', callback=self._arrived,
+		                                 timeout=0, stream=_chunk)
+
+	def search(self, text):
+		"""Returns Results holding the songs matching every word in text, in
+		library order. No words match nothing."""
+		words = fold(text).split()
+		if not words:
+			return Results([], iter([]))
+		# The longest word is likely the rarest, scan for that one.
+		words.sort(key=len, reverse=True)
+		return Results(self._index.songs, self._index.matches(words))
+
+	def _begin(self):
+		self._next = _Index()
+		if not self._index.songs:
+			# Nothing to search yet, so search what arrived so far.
+			self._index = self._next
+
+	def _arrived(self, entries):
+		"""A batch of our own listallinfo, [] once it is complete."""
+		if not entries:
+			self._request = None
+			self._finish()
+		else:
+			self._add([Song(entry) for entry in entries
+			           if 'file' in entry]) # Not a directory or playlist.
+
+	def _songs_arrived(self, songs):
+		"""A batch of the LibraryModel's songs, [] once it has all of them."""
+		if self._next is None:
+			self._begin()
+		if not songs:
+			self._finish()
+		else:
+			self._add(songs)
+
+	def _add(self, songs):
+		index = self._next
+		for song in songs:
+			index.add(song)
+		if index is self._index:
+			signals.emit('search_index_changed')
+
+	def _finish(self):
+		index = self._next
+		index.flush()
+		self._next = None
+		self._index = index
+		self.complete = True
+		signals.emit('search_index_changed')
+
+	def _database_changed(self):
+		if self._shared:
+			# The model loads everything again; the old index does till then.
+			self._next = None
+			self.complete = False
+			return
+		if self._request is None and not self.complete:
+			return # Never loaded, nobody searched.
+		if self._request is not None:
+			self._request.cancel()
+			self._request = None
+		self.complete = False
+		self.load()
+
+if __name__ == '__main__':
+	# Keystroke benchmark on a made-up library: python search.py [songs]
+	import sys
+	import time
+	import random
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+	random.seed(0)
+	# Zipf distributed words, like in real tags: a few are everywhere.
+	vocabulary = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz')
+	                      for _ in xrange(random.randint(2, 9))) for _ in xrange(50000)]
+	weights = [1.0 / rank for rank in xrange(1, len(vocabulary) + 1)]
+	total = sum(weights)
+	cumulative = []
+	for weight in weights:
+		cumulative.append((cumulative[-1] if cumulative else 0) + weight / total)
+	import bisect
+	def word():
+		return vocabulary[min(bisect.bisect(cumulative, random.random()), len(vocabulary) - 1)]
+	def words(low, high):
+		return ' '.join(word() for _ in xrange(random.randint(low, high)))
+	artists = [words(1, 3).title() for _ in xrange(count // 25)]
+	index = SearchIndex.__new__(SearchIndex)
+	index._index = index._next = _Index()
+	index._request = True
+	spent = 0.0
+	entries = []
+	for n in xrange(count):
+		artist = artists[n // 25]
+		album = words(1, 4).title()
+		title = words(1, 5).capitalize()
+		entries.append({'file': '%s/%s/%02d %s.flac' % (artist, album, n % 10, title),
+		                'artist': artist, 'album': album, 'title': title})
+		if len(entries) == _chunk or n == count - 1:
+			start = time.time()
+			index._arrived(entries)
+			spent += time.time() - start
+			entries = []
+	index._arrived([])
+	print '%d songs in %d blocks, %d trigrams, indexed in %.1fs' % (len(index.songs),
+		len(index._index.texts), len(index._index.grams), spent)
+	rows = 60 # A screenful.
+	probes = [artists[1234].lower(), index.songs[4321].title.lower(),
+	          vocabulary[3] + ' ' + vocabulary[40], 'flac', 'zzz']
+	for query in probes:
+		times = []
+		for end in xrange(1, len(query) + 1):
+			start = time.time()
+			found = index.search(query[:end])
+			try:
+				found[rows - 1]
+			except IndexError as e:
+				pass
+			times.append((time.time() - start) * 1000)
+		start = time.time()
+		count = len(index.search(query))
+		print '%-28r screenful in %4.1f ms at most, %4.1f ms last; all %6d in %4.0f ms' % (
+			query, max(times), times[-1], count, (time.time() - start) * 1000)
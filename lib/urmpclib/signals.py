@@ -54,9 +54,24 @@ def alarm_remove(handle):
 	except AttributeError as e:
 		pass # Not fully initialized, no big deal. Might want it on debug log.
 
+def watch_file(fd, callback):
+	try:
+		return _mainloop.watch_file(fd, callback)
+	except AttributeError as e:
+		pass # Not fully initialized, no big deal. Might want it on debug log.
+
 def redraw():
+	"""Asks for the screen to be drawn. Requests are coalesced, see
+	util.MainLoop."""
 	try:
 		return _mainloop.draw_screen()
 	except AttributeError as e:
 		pass # Not fully initialized, no big deal. Might want it on debug log.
 
+
+def draw_stats():
+	"""Redraws asked for and redraws done so far, see util.MainLoop."""
+	try:
+		return _mainloop.requested, _mainloop.performed
+	except AttributeError as e:
+		return 0, 0
@@ -0,0 +1,137 @@
+"""Compact storage for songs as returned by python-mpd."""
+
+class Song(object):
+	"""Stand-in for python-mpd's song dicts, at a fraction of the memory.
+
+	Common tags live in slots instead of a per-song dict, and artist, album
+	and genre strings are interned so each distinct value is stored once.
+	Other tags go into a dict that only exists if there are any.
+	Songs are read-only and support the parts of the dict protocol the UI
+	uses: song['title'], song.get('title'), 'title' in song."""
+	__slots__ = ('file', 'artist', 'album', 'albumartist', 'title', 'genre',
+	             'track', 'disc', 'date', 'time', 'pos', 'id', '_extra')
+	_interned = frozenset(('artist', 'album', 'albumartist', 'genre', 'date'))
+
+	def __init__(self, tags):
+		for key in self.__slots__:
+			setattr(self, key, None)
+		extra = {}
+		for key, value in tags.iteritems():
+			if key in self._interned:
+				value = _intern(value)
+			if key in _slots:
+				setattr(self, key, value)
+			else:
+				extra[key] = value
+		if extra:
+			self._extra = extra
+
+	def __getitem__(self, key):
+		value = self.get(key)
+		if value is None:
+			raise KeyError(key)
+		return value
+
+	def get(self, key, default=None):
+		if key in _slots:
+			value = getattr(self, key)
+		elif self._extra is not None:
+			value = self._extra.get(key)
+		else:
+			value = None
+		if value is None:
+			return default
+		return value
+
+	def __contains__(self, key):
+		return self.get(key) is not None
+
+	def keys(self):
+		keys = [k for k in _slots if getattr(self, k) is not None]
+		if self._extra is not None:
+			keys.extend(self._extra)
+		return keys
+
+	def __eq__(self, other):
+		if not isinstance(other, Song):
+			return NotImplemented
+		return self.file == other.file and self.id == other.id
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		if equal is NotImplemented:
+			return equal
+		return not equal
+	def __hash__(self):
+		return hash((self.file, self.id))
+
+	def __repr__(self):
+		return 'Song(%r)' % dict((k, self[k]) for k in self.keys())
+
+_slots = frozenset(k for k in Song.__slots__ if not k.startswith('_'))
+
+def compact(song):
+	"""Returns song as a Song, converting it if it is a dict."""
+	if isinstance(song, Song):
+		return song
+	return Song(song)
+
+def _intern(value):
+	"""Interns str values, including each value of a multi-valued tag."""
+	if isinstance(value, str):
+		return intern(value)
+	if isinstance(value, list):
+		return [_intern(v) for v in value]
+	return value
+
+def _measure(objects):
+	"""Bytes held by objects, counting every shared object only once."""
+	import sys
+	seen = set()
+	total = 0
+	stack = list(objects)
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		total += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			stack.extend(obj.keys())
+			stack.extend(obj.values())
+		elif isinstance(obj, list):
+			stack.extend(obj)
+		elif isinstance(obj, Song):
+			stack.extend(getattr(obj, k) for k in Song.__slots__)
+	return total
+
+if __name__ == '__main__':
+	# Memory benchmark: python-mpd dicts against Song for synthetic songs.
+	# python-mpd builds fresh key and value strings for every song it parses,
+	# which the ''.join() calls below imitate.
+	import sys
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	def parsed(text):
+		return ''.join(list(text))
+	dicts = []
+	for n in xrange(count):
+		artist = n // 100
+		dicts.append({
+			parsed('file'): parsed('Artist %d/Album %d/%02d Title %d.flac'
+			                       % (artist, n // 10, n % 10, n)),
+			parsed('artist'): parsed('Artist %d' % artist),
+			parsed('album'): parsed('Album %d' % (n // 10)),
+			parsed('title'): parsed('Title %d' % n),
+			parsed('genre'): parsed('Genre %d' % (artist % 20)),
+			parsed('date'): parsed(str(1960 + artist % 50)),
+			parsed('track'): parsed(str(n % 10)),
+			parsed('time'): parsed(str(180 + n % 120)),
+			parsed('last-modified'): parsed('2011-10-28T12:00:00Z'),
+		})
+	before = _measure([dicts]) - sys.getsizeof(dicts)
+	songs = [Song(tags) for tags in dicts]
+	del dicts
+	after = _measure([songs]) - sys.getsizeof(songs)
+	print '%d songs' % count
+	print 'dict: %7.1f bytes/song' % (float(before) / count)
+	print 'Song: %7.1f bytes/song (%.0f%%)' % (float(after) / count,
+	                                          100.0 * after / before)
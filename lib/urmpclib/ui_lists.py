@@ -1,15 +1,28 @@
+import bisect
 import urwid
 import mpd
 
 import signals
 import util
+import cache
+from song import Song, compact
 import configuration
 from configuration import config
 
+def sort_key():
+	"""Returns the sort key for artists and albums, as configured."""
+	library = config.library
+	return util.collation_key(library.sort_articles,
+	                          configuration.truthiness(library.sort_fold_accents),
+	                          configuration.truthiness(library.sort_locale))
+
 class IOWalker(urwid.ListWalker):
-	def __init__(self):
+	def __init__(self, items=None):
+		"""items: list-like to keep items in, a new list by default."""
 		self.focus = 0
-		self.items = []
+		self.items = [] if items is None else items
+		# Widgets by _cache_key(item), kept across reloads.
+		self._formatcache = cache.LRUCache(int(config.format.widget_cache))
 		self._reload()
 
 	def get_focus(self):
@@ -37,17 +50,49 @@ class IOWalker(urwid.ListWalker):
 		item = self._get_raw(pos)
 		if item is None:
 			return None, None
-		if id(item) not in self._formatcache:
-			self._formatcache[id(item)] = self._format(item)
-		return self._formatcache[id(item)], pos
+		key = self._cache_key(item)
+		widget = self._formatcache.get(key)
+		if widget is None:
+			widget = self._formatcache[key] = self._format(item)
+		return widget, pos
+
+	def cache_stats(self):
+		"""Hits, misses and evictions of the widget cache."""
+		return self._formatcache.stats()
+
+	def locate(self, text):
+		"""Position of the first item sorting at or after text, None if the
+		items are in no order text could be looked up in."""
+		if not isinstance(self.items, util.SortedValues) or not self.items:
+			return None
+		return min(self.items.find(text), len(self.items) - 1)
+
+	_held = False # Whether focus changes are kept from those following it.
+	_held_item = None # What had the focus when they started to be.
+	def hold(self):
+		"""Stops telling others about focus changes, i.e. while jumping."""
+		self._held = True
+		self._held_item = self._get_raw(self.focus)
+	def release(self):
+		"""Tells others about the focus once, as it is now, unless it ended
+		up where it was at hold()."""
+		self._held = False
+		item, self._held_item = self._held_item, None
+		if self._get_raw(self.focus) != item:
+			self.set_focus(self.focus)
 
 	def _reload(self):
 		"""Grab items from datastore and apply any changes, attempting to
 		preserve focus as intelligently as possible."""
-		self._formatcache = {}
 		focus = self.focus
 		item = self._get_raw(focus)
-		self.items[:] = self._get_items()
+		self._update_items()
+		self._restore_focus(focus, item)
+		return True
+
+	def _restore_focus(self, focus, item):
+		"""Puts focus back on item, which was at position focus before
+		self.items changed, or as close to where it was as possible."""
 		count = len(self.items)
 		try:
 			if focus >= count or item != self.items[focus]:
@@ -60,35 +105,130 @@ class IOWalker(urwid.ListWalker):
 			else:
 				self.focus = 0
 		self._modified()
-		return True
+
+	def _update_items(self):
+		"""Brings self.items up to date with the datastore.
+		By default everything is fetched anew, override this if the datastore
+		can tell us what actually changed."""
+		self.items[:] = self._get_items()
 
 	# Override these.
 	def _get_items(self):
 		"""Returns a fresh copy of the items from the datastore."""
 		return []
+	def _cache_key(self, item):
+		"""Returns a hashable key that is equal for items that format alike."""
+		return item
 	def _format(self, item):
 		"""Returns a widget suitable for display."""
 		return item
 
+class BackgroundWalker(IOWalker):
+	"""IOWalker that loads its items with mpc.request(), so the UI keeps
+	going while MPD answers. Items are applied when they arrive; a load still
+	pending when the next one starts is cancelled. Results come from the
+	client's query cache when possible, or from the LibraryModel if the
+	walker has one and it knows the answer already.
+
+	While a load is pending an empty walker shows a placeholder. Columns that
+	follow another one's focus should use _reload_later(), which waits for
+	the focus to settle so scrolling doesn't send a query per keypress."""
+	_request = None
+	_alarm = None
+	_loading = False
+	model = None # A library.LibraryModel, if any.
+
+	def __init__(self, items=None):
+		self._delay = float(config.library.load_delay)
+		placeholder = urwid.Text(config.format.library.loading, wrap='clip')
+		self._placeholder = urwid.AttrMap(placeholder,
+		                                  {None: 'library.column'},
+		                                  {None: 'library.column.focus'})
+		super(BackgroundWalker, self).__init__(items)
+
+	# Override these.
+	def _query(self):
+		"""Returns (command, args...) to fetch the items, None for no items."""
+		return None
+	def _prepare(self, result):
+		"""Turns the command's result into items."""
+		return result
+	def _known(self):
+		"""Returns the result from memory if the model has it, else None."""
+		return None
+
+	def _get_at_pos(self, pos):
+		if pos == 0 and self._loading and not self.items:
+			return self._placeholder, 0
+		return super(BackgroundWalker, self)._get_at_pos(pos)
+
+	def _reload(self):
+		self._cancel()
+		query = self._query()
+		known = self._known()
+		if query is None:
+			self._loaded([])
+		elif known is not None:
+			self._loaded(known)
+		else:
+			self._loading = True
+			self._request = self.mpc.request(*query, callback=self._loaded,
+			                                 cache=True)
+		return True
+
+	def _reload_later(self):
+		"""Empties the walker and loads it once config.library.load_delay
+		seconds pass without another call superseding this one."""
+		self._wait()
+		self._alarm = signals.alarm_in(self._delay, lambda *_: self._reload())
+
+	def _wait(self):
+		"""Empties the walker and shows the placeholder until told otherwise."""
+		self._cancel()
+		del self.items[:]
+		self.focus = 0
+		self._loading = True
+		self._modified()
+
+	def _cancel(self):
+		"""Drops any pending load, before it is sent if possible."""
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+			self._alarm = None
+		if self._request is not None:
+			self._request.cancel()
+			self._request = None
+
+	def _loaded(self, result):
+		"""Applies freshly loaded items, preserving focus like _reload()."""
+		self._request = None
+		self._loading = False
+		focus = self.focus
+		item = self._get_raw(focus)
+		self.items[:] = self._prepare(result)
+		self._restore_focus(focus, item)
+
 @signals.sends_signal('change')
-class ArtistWalker(IOWalker):
-	def __init__(self, mpc):
+class ArtistWalker(BackgroundWalker):
+	def __init__(self, mpc, model=None):
 		self.mpc = mpc
-		ignore_leading_the = config.format.library.ignore_leading_the
-		if configuration.truthiness(ignore_leading_the):
-			def sort(artist):
-				artist = artist.lower()
-				if artist.startswith('the '):
-					return artist[4:]
-				return artist
-			self._sort = sort
-		else:
-			self._sort = lambda artist: artist.lower()
-		super(ArtistWalker, self).__init__()
+		self.model = model
+		# Reloads only sort what was added, and find the focus by value.
+		super(ArtistWalker, self).__init__(util.SortedValues(sort_key()))
 		signals.listen('idle_database', self._reload)
 
-	def _get_items(self):
-		return sorted(self.mpc.list('artist'), key=self._sort)
+	def _query(self):
+		return 'list', 'artist'
+
+	def _known(self):
+		if self.model is not None:
+			return self.model.artists()
+
+	def _loaded(self, result):
+		super(ArtistWalker, self)._loaded(result)
+		self.set_focus(self.focus) # Let the album column follow.
+		if self.model is not None:
+			self.model.start()
 
 	def _format(self, item):
 		if item == '':
@@ -102,33 +242,60 @@ class ArtistWalker(IOWalker):
 
 	def set_focus(self, focus):
 		super(ArtistWalker, self).set_focus(focus)
-		urwid.emit_signal(self, 'change', self.items[focus])
+		if self._held:
+			return
+		if self.model is not None:
+			self.model.set_focus(self.items, focus)
+		if focus < len(self.items):
+			urwid.emit_signal(self, 'change', self.items[focus])
 
 	def play_current(self):
-		song_id = self.queue_current()
-		if song_id is not None:
-			self.mpc.playid(song_id)
+		item = super(ArtistWalker, self)._get_raw(self.focus)
+		if item is None:
+			return
+		song_ids = self.mpc.enqueue_ids('artist', item)
+		self._notify_added(item, len(song_ids))
+		if song_ids:
+			self.mpc.playid(song_ids[0])
 	def queue_current(self):
+		"""Returns how many songs were added."""
 		item = super(ArtistWalker, self)._get_raw(self.focus)
 		if item is None:
 			return None
-		song_id = None
-		for song in self.mpc.find('artist', item):
-			sid = self.mpc.addid(song['file'])
-			if song_id is None:
-				song_id = sid
-		signals.emit('user_notification', 'Adding artist "%s"' % item)
-		return song_id
+		count = self.mpc.enqueue('artist', item)
+		self._notify_added(item, count)
+		return count
+
+	def _notify_added(self, item, count):
+		signals.emit('user_notification',
+		             'Adding artist "%s" (%d songs)' % (item, count))
 
 @signals.sends_signal('change')
-class AlbumWalker(IOWalker):
-	def __init__(self, mpc, artist):
+class AlbumWalker(BackgroundWalker):
+	def __init__(self, mpc, artist, model=None):
 		self.mpc = mpc
 		self.artist = artist
-		super(AlbumWalker, self).__init__()
+		self.model = model
+		super(AlbumWalker, self).__init__(util.SortedValues(sort_key()))
 
-	def _get_items(self):
-		return sorted(self.mpc.list('album', 'artist', self.artist))
+	def _query(self):
+		if self.artist is None:
+			return None
+		return 'list', 'album', 'artist', self.artist
+
+	def _known(self):
+		if self.model is not None:
+			return self.model.albums(self.artist)
+
+	def _reload(self):
+		super(AlbumWalker, self)._reload()
+		if self.model is not None:
+			self.model.prefetch() # Sent apart, the load above doesn't wait.
+		return True
+
+	def _loaded(self, result):
+		super(AlbumWalker, self)._loaded(result)
+		self.set_focus(self.focus) # Let the track column follow.
 
 	def _format(self, item):
 		if item == '':
@@ -142,40 +309,59 @@ class AlbumWalker(IOWalker):
 
 	def set_focus(self, focus):
 		super(AlbumWalker, self).set_focus(focus)
-		urwid.emit_signal(self, 'change', (self.artist, self.items[focus]))
+		if self._held:
+			return
+		if focus < len(self.items):
+			urwid.emit_signal(self, 'change', (self.artist, self.items[focus]))
 
 	def change_artist(self, value):
 		self.artist = value
-		self._reload()
-		self.set_focus(self.focus)
+		self._reload_later()
+		# Our albums are stale now, and so are the tracks following them.
+		urwid.emit_signal(self, 'change', (self.artist, None))
 
 	def play_current(self):
-		song_id = self.queue_current()
-		if song_id is not None:
-			self.mpc.playid(song_id)
+		item = super(AlbumWalker, self)._get_raw(self.focus)
+		if item is None:
+			return
+		song_ids = self.mpc.enqueue_ids('artist', self.artist, 'album', item)
+		self._notify_added(item, len(song_ids))
+		if song_ids:
+			self.mpc.playid(song_ids[0])
 	def queue_current(self):
+		"""Returns how many songs were added."""
 		item = super(AlbumWalker, self)._get_raw(self.focus)
 		if item is None:
 			return None
-		song_id = None
-		for song in self.mpc.find('artist', self.artist, 'album', item):
-			sid = self.mpc.addid(song['file'])
-			if song_id is None:
-				song_id = sid
-		signals.emit('user_notification', 'Adding album "%s" - %s' % (item, self.artist))
-		return song_id
+		count = self.mpc.enqueue('artist', self.artist, 'album', item)
+		self._notify_added(item, count)
+		return count
+
+	def _notify_added(self, item, count):
+		signals.emit('user_notification', 'Adding album "%s" - %s (%d songs)'
+		             % (item, self.artist, count))
 
 
-class TrackWalker(IOWalker):
-	def __init__(self, mpc, artist, album):
+class TrackWalker(BackgroundWalker):
+	def __init__(self, mpc, artist, album, model=None):
 		self.mpc = mpc
 		self.artist = artist
 		self.album = album
+		self.model = model
 		super(TrackWalker, self).__init__()
 
-	def _get_items(self):
+	def _query(self):
+		if self.album is None:
+			return None
 		#TODO: Make sure this sorts like it should.
-		return self.mpc.find('artist', self.artist, 'album', self.album)
+		return 'find', 'artist', self.artist, 'album', self.album
+
+	def _prepare(self, songs):
+		return map(compact, songs)
+
+	def _known(self):
+		if self.model is not None:
+			return self.model.tracks(self.artist, self.album)
 
 	def _format(self, item):
 		try:
@@ -192,8 +378,12 @@ class TrackWalker(IOWalker):
 		return text
 
 	def change_album(self, artist_album):
+		"""album is None while the album column is still loading."""
 		self.artist, self.album = artist_album
-		self._reload()
+		if self.album is None:
+			self._wait()
+		else:
+			self._reload_later()
 
 	def play_current(self):
 		song_id = self.queue_current()
@@ -203,11 +393,10 @@ class TrackWalker(IOWalker):
 		item = super(TrackWalker, self)._get_raw(self.focus)
 		if item is None:
 			return None
-		song = self.mpc.find('file', item['file'])
-		if song == []:
-			return None
-		song = song[0]
-		song_id = self.mpc.addid(song['file'])
+		try:
+			song_id = self.mpc.addid(item['file'])
+		except mpd.CommandError as e:
+			return None # Gone from the database since we listed it.
 
 		#TODO: Do this like self._format, this is ugly.
 		try:
@@ -222,6 +411,640 @@ class TrackWalker(IOWalker):
 		signals.emit('user_notification', 'Adding "%s" by %s' % (name, artist))
 		return song_id
 
+class LibraryTreeWalker(IOWalker):
+	"""The library as a single list in which artists expand into their albums
+	and albums into their tracks. Items are the rows on display, as paths:
+	(artist,), (artist, album) or (artist, album, Song); a path ending in
+	None stands for children still being loaded.
+
+	Children are only asked for when their parent is expanded, through
+	mpc.request(..., cache=True), so they are kept in the client's bounded
+	query cache (or come from the LibraryModel) rather than in here.
+	Collapsing a row drops the rows and widgets of everything below it, so
+	what is held follows what is on display, not the size of the library.
+	Every row also has a sort key, kept in order alongside the rows, so the
+	row to expand or collapse is found by bisecting rather than searching."""
+
+	def __init__(self, mpc, model=None):
+		self.mpc = mpc
+		self.model = model
+		self._key = sort_key()
+		self._expanded = set() # Rows showing their children.
+		self._keys = [] # _row_key() of each of items, in the same order.
+		self._requests = {} # {row, () for the artists: Request}
+		self._expanded_mark = config.format.library.expanded
+		self._collapsed_mark = config.format.library.collapsed
+		self._indent = ' ' * urwid.util.calc_width(self._collapsed_mark, 0,
+		                                           len(self._collapsed_mark))
+		super(LibraryTreeWalker, self).__init__()
+		signals.listen('idle_database', self._reload)
+
+	def _reload(self):
+		for request in self._requests.values():
+			request.cancel()
+		self._requests = {}
+		# Tags may have changed, rows showing them have to be made anew.
+		self._formatcache.clear()
+		if not self.items:
+			self.items.append((None,))
+			self._keys.append(None)
+		known = None
+		if self.model is not None:
+			known = self.model.artists()
+		if known is not None:
+			self._artists_loaded(known)
+		else:
+			self._pending((), self.mpc.request('list', 'artist', cache=True,
+			                                   callback=self._artists_loaded))
+		return True
+
+	def _artists_loaded(self, artists):
+		self._requests.pop((), None)
+		focus = self.focus
+		item = self._get_raw(focus)
+		rows = sorted((self._row_key((artist,)), (artist,)) for artist in artists)
+		self._keys = [key for key, row in rows]
+		self.items = [row for key, row in rows]
+		# Whatever was below the artists comes back as it is loaded again.
+		self._restore_focus(focus, item and item[:1])
+		artists = set(artists)
+		for row in [row for row in self._expanded if len(row) == 1]:
+			if row[0] in artists:
+				self._open(row)
+			else:
+				self._close(row)
+		if self.model is not None:
+			self.model.start()
+
+	def expand(self):
+		row = self._get_raw(self.focus)
+		if row is None or row[-1] is None or len(row) == 3:
+			return
+		if row not in self._expanded:
+			self._expanded.add(row)
+			self._open(row)
+
+	def collapse(self):
+		"""Collapses the focused row, or if it isn't expanded, its parent."""
+		row = self._get_raw(self.focus)
+		if row is None:
+			return
+		if row not in self._expanded:
+			row = row[:-1]
+			if not row:
+				return
+			self.focus = self._index(row)
+		self._close(row)
+
+	def _open(self, row):
+		"""Shows the children of row, which is shown and expanded."""
+		pos = self._index(row)
+		loading = row + (None,)
+		self._splice(pos + 1, pos + 1, [loading], [self._row_key(loading)])
+		if len(row) == 1:
+			query = 'list', 'album', 'artist', row[0]
+			known = self.model and self.model.albums(row[0])
+		else:
+			query = 'find', 'artist', row[0], 'album', row[1]
+			known = self.model and self.model.tracks(row[0], row[1])
+		if known is not None:
+			self._arrived(row, known)
+		else:
+			callback = lambda result: self._arrived(row, result)
+			errback = lambda error: self._failed(row, error)
+			self._pending(row, self.mpc.request(*query, callback=callback,
+			                                    errback=errback, cache=True))
+
+	def _pending(self, row, request):
+		# Cached results are done with before request() even returns.
+		if not request.cancelled:
+			self._requests[row] = request
+
+	def _arrived(self, row, result):
+		self._requests.pop(row, None)
+		if row not in self._expanded:
+			return
+		if len(row) == 1:
+			children = sorted((self._row_key(row + (album,)), row + (album,))
+			                  for album in result)
+		else:
+			parent = self._row_key(row)
+			children = [(parent + (i,), row + (compact(song),))
+			            for i, song in enumerate(result)]
+		pos = self._index(row + (None,))
+		self._splice(pos, pos + 1, [child for key, child in children],
+		             [key for key, child in children])
+		for key, child in children:
+			if child in self._expanded:
+				self._open(child)
+
+	def _failed(self, row, error):
+		self._requests.pop(row, None)
+		self._close(row)
+		signals.emit('user_notification', str(error))
+
+	def _close(self, row):
+		"""Collapses row, forgetting about everything below it."""
+		below = lambda other: other[:len(row)] == row
+		self._expanded = set(other for other in self._expanded if not below(other))
+		for other in filter(below, self._requests):
+			self._requests.pop(other).cancel()
+		try:
+			pos = self._index(row)
+		except ValueError as e:
+			return # Not shown, nothing below it either.
+		end = pos + 1
+		while end < len(self.items) and below(self.items[end]):
+			# Whether it was expanded a moment ago or not, it isn't now.
+			self._formatcache.pop((self.items[end], False))
+			self._formatcache.pop((self.items[end], True))
+			end += 1
+		self._formatcache.pop((row, True))
+		self._splice(pos + 1, end, [], [])
+
+	def _row_key(self, row):
+		"""Orders rows as shown: artists, then albums within their artist,
+		by collation key and then by name; rows still loading come first.
+		Tracks keep the order they came in, their key is the album's plus
+		their position."""
+		key = tuple(None if value is None else (self._key(value), value)
+		            for value in row[:2])
+		if len(row) == 3:
+			key += (None,)
+		return key
+
+	def _index(self, row):
+		"""Position of row, which can't be a track; ValueError if not shown."""
+		pos = bisect.bisect_left(self._keys, self._row_key(row))
+		if pos < len(self.items) and self.items[pos] == row:
+			return pos
+		raise ValueError(row)
+
+	def _splice(self, start, end, rows, keys):
+		"""Replaces items[start:end] with rows, whose _row_key()s are keys.
+		Focus stays on its row; if that was replaced it goes to the first of
+		rows, or the one above."""
+		self.items[start:end] = rows
+		self._keys[start:end] = keys
+		if self.focus >= end:
+			self.focus += len(rows) - (end - start)
+		elif self.focus >= start and not rows:
+			self.focus = max(start - 1, 0)
+		self._modified()
+
+	def _cache_key(self, item):
+		return item, item in self._expanded
+
+	def _format(self, item):
+		depth = len(item) - 1
+		value = item[-1]
+		if value is None:
+			text = config.format.library.loading
+		elif depth == 2:
+			text = value.get('title', value.file)
+		else:
+			text = value or config.format.empty_tag
+		if value is None or depth == 2:
+			mark = self._indent
+		elif item in self._expanded:
+			mark = self._expanded_mark
+		else:
+			mark = self._collapsed_mark
+		text = urwid.Text([self._indent * depth + mark, text], wrap='clip')
+		return urwid.AttrMap(text,
+		                     {None: 'library.column'},
+		                     {None: 'library.column.focus'})
+
+	def play_current(self):
+		row = self._get_raw(self.focus)
+		if row is None or row[-1] is None:
+			return
+		if len(row) == 3:
+			song_id = self.queue_current()
+			if song_id is not None:
+				self.mpc.playid(song_id)
+			return
+		song_ids = self.mpc.enqueue_ids(*self._find_args(row))
+		self._notify_added(row, len(song_ids))
+		if song_ids:
+			self.mpc.playid(song_ids[0])
+
+	def queue_current(self):
+		"""Returns how many songs were added, or the song id for a track."""
+		row = self._get_raw(self.focus)
+		if row is None or row[-1] is None:
+			return None
+		if len(row) == 3:
+			song = row[2]
+			try:
+				song_id = self.mpc.addid(song.file)
+			except mpd.CommandError as e:
+				return None # Gone from the database since we listed it.
+			signals.emit('user_notification', 'Adding "%s" by %s' % (
+				song.get('title', song.file), song.get('artist', config.format.empty_tag)))
+			return song_id
+		count = self.mpc.enqueue(*self._find_args(row))
+		self._notify_added(row, count)
+		return count
+
+	def _find_args(self, row):
+		args = ('artist', row[0])
+		if len(row) > 1:
+			args += ('album', row[1])
+		return args
+
+	def _notify_added(self, row, count):
+		if len(row) == 1:
+			message = 'Adding artist "%s" (%d songs)' % (row[0], count)
+		else:
+			message = 'Adding album "%s" - %s (%d songs)' % (row[1], row[0], count)
+		signals.emit('user_notification', message)
+
+class _Listing(object):
+	"""lsinfo of a directory, as far as it arrived."""
+	complete = False
+
+	def __init__(self, request=None):
+		self.entries = []
+		self.request = request
+
+@signals.sends_signal('change')
+class DirectoryWalker(IOWalker):
+	"""The music directory, one directory at a time, as lsinfo lists it:
+	subdirectories first, then files. Emits 'change' with the new path when
+	another directory is shown.
+
+	Listings stream in, so a huge directory shows its first entries while
+	the rest is on its way, and complete ones are kept in an LRU cache until
+	the database changes. When the focus rests on a subdirectory for
+	config.library.load_delay seconds, it is listed ahead of time."""
+	_chunk = 500 # Entries per streamed batch.
+	_alarm = None
+	_prefetching = None # Path listed ahead of time, if any.
+	_focus_on = None # Path to focus once it arrives.
+
+	def __init__(self, mpc):
+		self.mpc = mpc
+		self.path = '' # The root.
+		self._delay = float(config.library.load_delay)
+		self._listings = cache.LRUCache(int(config.library.browse_cache))
+		self._pending = {} # {path: _Listing} still arriving.
+		placeholder = urwid.Text(config.format.library.loading, wrap='clip')
+		self._placeholder = urwid.AttrMap(placeholder,
+		                                  {None: 'library.column'},
+		                                  {None: 'library.column.focus'})
+		super(DirectoryWalker, self).__init__()
+		signals.listen('idle_database', self._database_changed)
+
+	def _reload(self):
+		self.open(self.path)
+		return True
+
+	def open(self, path, focus_on=None):
+		"""Shows directory path, focusing entry focus_on once it is listed."""
+		self.path = path
+		listing = self._listings.get(path)
+		if listing is None:
+			listing = self._pending.get(path) or self._load(path)
+			if path == self._prefetching:
+				self._prefetching = None # Wanted now, don't let go of it.
+			listing = listing.entries
+		self.items = listing
+		self.focus = 0
+		self._focus_on = focus_on
+		self._find_focus()
+		self._forget_pending()
+		self._modified()
+		urwid.emit_signal(self, 'change', path)
+
+	def open_current(self):
+		item = self._get_raw(self.focus)
+		if item is not None and 'directory' in item:
+			self.open(item['directory'])
+
+	def open_parent(self):
+		if self.path:
+			self.open(self.path.rpartition('/')[0], focus_on=self.path)
+
+	def _load(self, path):
+		listing = self._pending[path] = _Listing()
+		callback = lambda entries: self._arrived(path, listing, entries)
+		errback = lambda error: self._failed(path, listing, error)
+		listing.request = self.mpc.request('lsinfo', path, callback=callback,
+		                                   errback=errback, timeout=0,
+		                                   stream=self._chunk)
+		return listing
+
+	def _arrived(self, path, listing, entries):
+		if entries:
+			listing.entries.extend(entry if 'directory' in entry else Song(entry)
+			                       for entry in entries if 'playlist' not in entry)
+		else:
+			listing.complete = True
+			del self._pending[path]
+			if path == self._prefetching:
+				self._prefetching = None
+			self._listings[path] = listing.entries
+		if listing.entries is self.items:
+			self._find_focus()
+			self._modified()
+
+	def _failed(self, path, listing, error):
+		del self._pending[path]
+		if path == self._prefetching:
+			self._prefetching = None
+		if listing.entries is self.items:
+			# Gone since we last looked, most likely.
+			signals.emit('user_notification', str(error))
+			if path:
+				self.open_parent()
+
+	def _forget_pending(self):
+		"""Stops loading what is neither shown nor being listed ahead."""
+		for path, listing in self._pending.items():
+			if path != self.path and path != self._prefetching:
+				listing.request.cancel()
+				del self._pending[path]
+
+	def _find_focus(self):
+		if self._focus_on is None:
+			return
+		for pos, item in enumerate(self.items):
+			if item.get('directory', item.get('file')) == self._focus_on:
+				self.focus = pos
+				self._focus_on = None
+				return
+
+	def set_focus(self, focus):
+		super(DirectoryWalker, self).set_focus(focus)
+		self._focus_on = None # The user moved on.
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+		self._alarm = signals.alarm_in(self._delay, lambda *_: self._prefetch())
+
+	def _prefetch(self):
+		"""Lists the focused subdirectory ahead of time, unless it is known."""
+		self._alarm = None
+		item = self._get_raw(self.focus)
+		if item is None or 'directory' not in item:
+			return
+		path = item['directory']
+		if path in self._listings or path in self._pending:
+			return
+		self._prefetching = path
+		self._forget_pending()
+		self._load(path)
+
+	def _database_changed(self):
+		for listing in self._pending.values():
+			listing.request.cancel()
+		self._pending = {}
+		self._prefetching = None
+		self._listings.clear()
+		item = self._get_raw(self.focus)
+		self.open(self.path, item and item.get('directory', item.get('file')))
+
+	def _get_at_pos(self, pos):
+		if pos == 0 and not self.items and self.path in self._pending:
+			return self._placeholder, 0
+		return super(DirectoryWalker, self)._get_at_pos(pos)
+
+	def _cache_key(self, item):
+		if 'directory' in item:
+			return 'directory', item['directory']
+		return item.file
+
+	def _format(self, item):
+		if 'directory' in item:
+			text = item['directory'].rpartition('/')[2] + '/'
+		else:
+			text = item.file.rpartition('/')[2]
+		text = urwid.Text(text, wrap='clip')
+		return urwid.AttrMap(text,
+		                     {None: 'library.column'},
+		                     {None: 'library.column.focus'})
+
+	def play_current(self):
+		"""Plays the focused file, or opens the focused directory."""
+		item = self._get_raw(self.focus)
+		if item is None:
+			return
+		if 'directory' in item:
+			self.open(item['directory'])
+			return
+		song_id = self.queue_current()
+		if song_id is not None:
+			self.mpc.playid(song_id)
+
+	def queue_current(self):
+		"""Adds the focused file, or everything below the focused directory."""
+		item = self._get_raw(self.focus)
+		if item is None:
+			return None
+		try:
+			if 'directory' in item:
+				self.mpc.add(item['directory'])
+				signals.emit('user_notification',
+				             'Adding directory "%s"' % item['directory'])
+				return True
+			song_id = self.mpc.addid(item.file)
+		except mpd.CommandError as e:
+			return None # Gone from the database since we listed it.
+		signals.emit('user_notification', 'Adding "%s"' % item.file)
+		return song_id
+
+@signals.sends_signal('change', 'stale')
+class StoredPlaylistWalker(BackgroundWalker):
+	"""Names of the stored playlists. Emits 'change' with the focused name
+	like ArtistWalker, and 'stale' with the names of playlists whose
+	contents changed, were added or removed since the last listing; MPD's
+	idle_stored_playlist doesn't say which ones, their Last-Modified does."""
+
+	def __init__(self, mpc):
+		self.mpc = mpc
+		self._stamps = {} # {name: last-modified}
+		super(StoredPlaylistWalker, self).__init__(util.SortedValues(sort_key()))
+		signals.listen('idle_stored_playlist', self._reload)
+
+	def _reload(self):
+		# Not for the query cache, it only knows about database changes.
+		self._cancel()
+		self._loading = True
+		self._request = self.mpc.request('listplaylists', callback=self._loaded)
+		return True
+
+	def _prepare(self, playlists):
+		modified = dict((playlist['playlist'], playlist.get('last-modified'))
+		                for playlist in playlists)
+		changed = [name for name in set(modified) | set(self._stamps)
+		           if modified.get(name) != self._stamps.get(name)]
+		self._stamps = modified
+		if changed:
+			urwid.emit_signal(self, 'stale', changed)
+		return modified.keys()
+
+	def _loaded(self, result):
+		super(StoredPlaylistWalker, self)._loaded(result)
+		self.set_focus(self.focus) # Let the contents follow.
+
+	def _format(self, item):
+		item = urwid.Text(item, wrap='clip')
+		return urwid.AttrMap(item,
+		                     {None: 'library.column'},
+		                     {None: 'library.column.focus'})
+
+	def set_focus(self, focus):
+		super(StoredPlaylistWalker, self).set_focus(focus)
+		if not self._held and focus < len(self.items):
+			urwid.emit_signal(self, 'change', self.items[focus])
+
+	def play_current(self):
+		"""Loads the focused playlist and plays its first song."""
+		name = self._get_raw(self.focus)
+		if name is None:
+			return
+		try:
+			with self.mpc.batch() as batch:
+				batch.status()
+				batch.load(name)
+		except mpd.CommandError as e:
+			signals.emit('user_notification', str(e))
+			return
+		self.mpc.play(int(batch.results[0]['playlistlength']))
+		self._notify_added(name)
+
+	def queue_current(self):
+		"""Loads the focused playlist, all of it in one command."""
+		name = self._get_raw(self.focus)
+		if name is None:
+			return None
+		try:
+			self.mpc.load(name)
+		except mpd.CommandError as e:
+			signals.emit('user_notification', str(e))
+			return None
+		self._notify_added(name)
+		return True
+
+	def _notify_added(self, name):
+		signals.emit('user_notification', 'Loading playlist "%s"' % name)
+
+class PlaylistContentsWalker(IOWalker):
+	"""Songs in a stored playlist, shown by StoredPlaylistWalker's focus.
+
+	A playlist is listed once the focus rests on it for
+	config.library.load_delay seconds, and streams in pages of
+	config.playlist.window songs, so a long one shows its start right away.
+	Complete ones are kept in an LRU cache until they are modified or the
+	database changes."""
+	name = None # Playlist shown.
+	_listing = None # Songs of the playlist being listed, as they arrive.
+	_request = None
+	_alarm = None
+
+	def __init__(self, mpc):
+		self.mpc = mpc
+		self._delay = float(config.library.load_delay)
+		self._page = int(config.playlist.window)
+		self._contents = cache.LRUCache(int(config.library.browse_cache))
+		placeholder = urwid.Text(config.format.library.loading, wrap='clip')
+		self._placeholder = urwid.AttrMap(placeholder,
+		                                  {None: 'library.column'},
+		                                  {None: 'library.column.focus'})
+		super(PlaylistContentsWalker, self).__init__()
+		signals.listen('idle_database', self._database_changed)
+
+	def change_playlist(self, name):
+		if name == self.name:
+			return
+		self.name = name
+		self._cancel()
+		self.items = self._contents.get(name) or []
+		self.focus = 0
+		self._modified()
+		if name not in self._contents:
+			self._alarm = signals.alarm_in(self._delay, lambda *_: self._reload())
+
+	def playlists_changed(self, names):
+		"""Forgets the contents of playlists named, showing one anew."""
+		for name in names:
+			self._contents.pop(name)
+		if self.name in names:
+			self._reload()
+
+	def _database_changed(self):
+		# Tags may have changed, the songs are shown anew.
+		self._contents.clear()
+		self._formatcache.clear()
+		self._reload()
+
+	def _reload(self):
+		self._cancel()
+		if self.name is None:
+			return True
+		self._listing = []
+		name = self.name
+		self._request = self.mpc.request('listplaylistinfo', name,
+			callback=lambda songs: self._arrived(name, songs),
+			timeout=0, stream=self._page)
+		if not self.items:
+			self.items = self._listing
+		return True
+
+	def _cancel(self):
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+			self._alarm = None
+		if self._request is not None:
+			self._request.cancel()
+			self._request = None
+		self._listing = None
+
+	def _arrived(self, name, songs):
+		listing = self._listing
+		if songs:
+			listing.extend(Song(song) for song in songs)
+			if listing is self.items:
+				self._modified()
+			return
+		self._request = None
+		self._listing = None
+		self._contents[name] = listing
+		if listing is not self.items:
+			# Shown anew: swap the contents in one go, focus staying put.
+			self.items = listing
+			self.focus = min(self.focus, max(len(listing) - 1, 0))
+			self._modified()
+
+	def _get_at_pos(self, pos):
+		if pos == 0 and not self.items and self.name is not None and \
+				self.name not in self._contents:
+			return self._placeholder, 0
+		return super(PlaylistContentsWalker, self)._get_at_pos(pos)
+
+	def _cache_key(self, item):
+		return item.file
+
+	def _format(self, item):
+		return PlaylistRow.of(item)
+
+	def play_current(self):
+		song_id = self.queue_current()
+		if song_id is not None:
+			self.mpc.playid(song_id)
+
+	def queue_current(self):
+		item = self._get_raw(self.focus)
+		if item is None:
+			return None
+		try:
+			song_id = self.mpc.addid(item.file)
+		except mpd.CommandError as e:
+			return None # Gone from the database since it was saved.
+		signals.emit('user_notification', 'Adding "%s" by %s' % (
+			item.get('title', item.file), item.get('artist', config.format.empty_tag)))
+		return song_id
+
 class TreeList(urwid.ListBox):
 	def __init__(self, *args, **kwargs):
 		actionmap = {
@@ -271,104 +1094,678 @@ class TreeList(urwid.ListBox):
 
 
 class PlayableList(TreeList):
+	"""TreeList of things to play. In a list whose walker can locate() text,
+	the jump key starts type-ahead: focus goes to the first item starting
+	with what is typed, found by bisecting rather than scrolling there.
+	Columns following this one only hear of the focus once the jump ends,
+	on any other key or config.library.jump_timeout seconds after the last
+	letter. Esc goes back to where the jump started."""
+	_typed = None # Text typed ahead so far, None when not jumping.
+	_alarm = None
+
 	def __init__(self, *args, **kwargs):
 		super(PlayableList, self).__init__(*args, **kwargs)
+		self._timeout = float(config.library.jump_timeout)
 		actionmap = {
 			'play': lambda _: self.body.play_current(),
 			'queue': lambda _: self.body.queue_current() and None,
+			'jump': lambda _: self._start_jump(),
 		}
 		self.keymap.update(actionmap, config.keymap.playable_list)
 
+	def keypress(self, size, key):
+		if self._typed is not None:
+			key = self._jump_keypress(key)
+			if key is None:
+				return None
+		return super(PlayableList, self).keypress(size, key)
+
+	def _start_jump(self):
+		if self.body.locate('') is None:
+			return
+		self._typed = u''
+		self._started = self.body.focus
+		self.body.hold()
+		self._show_jump()
+
+	def _jump_keypress(self, key):
+		"""Handles key while jumping; returns it if it ends the jump."""
+		if isinstance(key, str):
+			key = key.decode('utf-8', 'replace')
+		if len(key) == 1 or key == 'backspace':
+			# Printable keys are single characters, named ones plain ASCII.
+			self._typed = self._typed[:-1] if key == 'backspace' else self._typed + key
+			focus = self.body.locate(self._typed.encode('utf-8'))
+			if focus is not None:
+				self.set_focus(focus)
+			self._show_jump()
+			return None
+		if key == 'esc':
+			self.set_focus(self._started)
+			key = None
+		elif key == 'enter':
+			key = None
+		self._end_jump()
+		return key
+
+	def _show_jump(self):
+		signals.emit('user_notification',
+		             'Jump to: ' + self._typed.encode('utf-8'), self._timeout)
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+		self._alarm = signals.alarm_in(self._timeout, lambda *_: self._end_jump())
+
+	def _end_jump(self):
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+			self._alarm = None
+		self._typed = None
+		self.body.release()
+
+class QueueWindow(object):
+	"""Stands in for the list of playlist songs in NowPlayingWalker.
+
+	Song ids are known for every position, but tags only for the rows around
+	the one looked at last. Looking at a row without tags fetches its
+	neighbourhood in the background and returns a placeholder holding just
+	'id' and 'pos' until the tags arrive. Memory therefore depends on the
+	window size rather than on the length of the playlist."""
+
+	def __init__(self, mpc, size, loaded, forget):
+		"""size: rows of tags to fetch at once; twice that are kept.
+		loaded(): called when fetched tags arrive.
+		forget(song): called for each song or placeholder dropped."""
+		self.mpc = mpc
+		self.ids = []
+		self._size = size
+		self._loaded = loaded
+		self._forget = forget
+		self._songs = {} # {id: song or placeholder}
+		self._pending = [] # [(start, end, Request)]
+		self._last = 0 # Position looked at last.
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, pos):
+		if pos < 0:
+			raise IndexError(pos)
+		songid = self.ids[pos]
+		self._last = pos
+		song = self._songs.get(songid)
+		if song is None:
+			song = self._songs[songid] = {'id': songid, 'pos': str(pos)}
+			self._fetch(pos)
+		return song
+
+	def index(self, song):
+		if song is None:
+			raise ValueError(song)
+		return self.ids.index(song['id'])
+
+	def move(self, old, new):
+		"""Moves the song at position old to new, like moveid does."""
+		self.ids.insert(new, self.ids.pop(old))
+
+	def replace(self, ids):
+		"""Takes ids as the new order after edits made here; songs no longer
+		in it are forgotten."""
+		keep = set(ids)
+		for songid in [songid for songid in self._songs if songid not in keep]:
+			self._forget(self._songs.pop(songid))
+		self.ids[:] = ids
+
+	def clear(self):
+		"""Forgets all tags, i.e. after the database changed."""
+		for start, end, request in self._pending:
+			request.cancel()
+		self._pending = []
+		for song in self._songs.values():
+			self._forget(song)
+		self._songs = {}
+
+	def apply_changes(self, changes, length):
+		"""Updates ids with plchangesposid output for a playlist of length.
+		Returns False if some position is still unaccounted for."""
+		ids = self.ids
+		del ids[length:]
+		ids.extend([None] * (length - len(ids)))
+		for change in changes:
+			pos = int(change['cpos'])
+			if pos < length:
+				ids[pos] = change['id']
+		return None not in ids
+
+	def _fetch(self, pos):
+		for start, end, request in self._pending:
+			if start <= pos < end:
+				return
+		start = max(pos - self._size // 2, 0)
+		end = min(start + self._size, len(self.ids))
+		callback = lambda songs: self._arrived(start, end, songs)
+		errback = lambda error: self._failed(start, end, error)
+		request = self.mpc.request('playlistinfo', '%d:%d' % (start, end),
+		                           callback=callback, errback=errback)
+		self._pending.append((start, end, request))
+
+	def _done(self, start, end):
+		self._pending = [p for p in self._pending if p[:2] != (start, end)]
+
+	def _failed(self, start, end, error):
+		"""Lets the range be asked for again the next time it is looked at."""
+		self._done(start, end)
+		for songid in self.ids[start:end]:
+			song = self._songs.get(songid)
+			if song is not None and 'file' not in song:
+				self._forget(self._songs.pop(songid))
+		signals.emit('user_notification', str(error))
+
+	def _arrived(self, start, end, songs):
+		self._done(start, end)
+		for tags in songs:
+			item = Song(tags)
+			old = self._songs.get(item.id)
+			if old is not None:
+				self._forget(old)
+			self._songs[item.id] = item
+		self._evict()
+		self._loaded()
+
+	def _evict(self):
+		"""Drops tags of songs far from the position looked at last."""
+		start = max(self._last - self._size, 0)
+		keep = set(self.ids[start:self._last + self._size])
+		for songid, song in self._songs.items():
+			if songid not in keep:
+				self._forget(song)
+				del self._songs[songid]
+
+class PlaylistRow(urwid.FlowWidget):
+	"""One playlist line: time, artist, title and album.
+
+	Renders straight into a single TextCanvas instead of laying out a
+	Columns of four Text widgets, and keeps what it rendered for as long as
+	the width stays the same, so scrolling mostly reuses canvases."""
+	_selectable = True
+	fields = ('time', 'artist', 'title', 'album')
+	# Column widths by screen width, shared by all rows.
+	_widths = {}
+
+	def __init__(self, time, artist, title, album, selected=False):
+		"""selected shows the whole row as playlist.selected."""
+		# Multi-valued tags come as lists, shown run together as Text did.
+		self._text = tuple(''.join(v) if isinstance(v, list) else v
+		                   for v in (time, artist, title, album))
+		self._selected = selected
+		self._maxcol = None
+		self._canvases = {} # {focus: canvas} at self._maxcol
+
+	@classmethod
+	def of(cls, song, selected=False):
+		"""The row showing song."""
+		empty = config.format.empty_tag
+		time = song.get('time', '')
+		if time != '':
+			time = str(util.timedelta(seconds=int(time)))
+		return cls(time, song.get('artist', empty), song.get('title', empty),
+		           song.get('album', empty), selected)
+
+	def rows(self, size, focus=False):
+		return 1
+
+	def keypress(self, size, key):
+		return key
+
+	@classmethod
+	def column_widths(cls, maxcol):
+		"""Same split as Columns: 6 fixed for time, then weights 1:1.5:1."""
+		widths = cls._widths.get(maxcol)
+		if widths is None:
+			widths = [min(6, maxcol)]
+			shared = maxcol - widths[0]
+			weights = 1.0, 1.5, 1.0
+			total = sum(weights)
+			for weight in weights:
+				width = int(float(shared) * weight / total + 0.5)
+				widths.append(width)
+				shared -= width
+				total -= weight
+			cls._widths[maxcol] = widths
+		return widths
+
+	def render(self, size, focus=False):
+		maxcol = size[0]
+		if maxcol != self._maxcol:
+			self._maxcol = maxcol
+			self._canvases = {}
+		canvas = self._canvases.get(focus)
+		if canvas is None:
+			canvas = self._canvases[focus] = self._render(maxcol, focus)
+		return canvas
+
+	def _render(self, maxcol, focus):
+		suffix = '.focus' if focus else ''
+		text, attr, cs = [], [], []
+		for i, width in enumerate(self.column_widths(maxcol)):
+			value = self._text[i]
+			used = urwid.util.calc_width(value, 0, len(value))
+			# Album is right aligned and, like a clipped Text, loses its start.
+			right = i == 3
+			if used > width and right:
+				pos, cut = urwid.util.calc_text_pos(value, 0, len(value), used - width)
+				if cut < used - width: # Half a wide character.
+					pos = urwid.util.move_next_char(value, pos, len(value))
+					cut = urwid.util.calc_width(value, 0, pos)
+				value, used = value[pos:], used - cut
+			elif used > width:
+				pos, used = urwid.util.calc_text_pos(value, 0, len(value), width)
+				value = value[:pos]
+			pad = ' ' * (width - used)
+			value = pad + value if right else value + pad
+			value, value_cs = urwid.util.apply_target_encoding(value)
+			text.append(value)
+			name = 'selected' if self._selected else self.fields[i]
+			attr.append(('playlist.' + name + suffix, len(value)))
+			cs.extend(value_cs)
+		return urwid.TextCanvas([''.join(text)], [attr], [cs], maxcol=maxcol)
+
 class NowPlayingWalker(IOWalker):
+	"""The playlist, kept in sync with plchangesposid and shown through a
+	QueueWindow so only rows near the focus hold tags or widgets."""
+	# Playlist version (status()['playlist']) that self.items reflects.
+	_version = None
+
 	def __init__(self, mpc):
 		self.mpc = mpc
-		super(NowPlayingWalker, self).__init__()
+		self._edits = [] # [(command, args...)] shown here but not yet sent.
+		# Selected song ids: tagged one by one, and the range between
+		# _anchor, another id, and the focus while selecting a range.
+		self._tagged = set()
+		self._range = set()
+		self._anchor = None
+		items = QueueWindow(mpc, int(config.playlist.window),
+		                    self._modified, self._forget)
+		super(NowPlayingWalker, self).__init__(items)
 		signals.listen('idle_playlist', self._reload)
+		signals.listen('idle_database', self._resync)
 
-	def _get_items(self):
-		return self.mpc.playlistinfo()
+	def _cache_key(self, item):
+		# Ids are unique within the playlist, and a song keeps its tags until
+		# the database changes, when _resync() drops all widgets.
+		return item['id'], 'file' in item, self._is_selected(item['id'])
 
-	def _format(self, item):
-		if 'artist' not in item: item['artist'] = config.format.empty_tag
-		if 'album' not in item: item['album'] = config.format.empty_tag
-		if 'title' not in item: item['title'] = config.format.empty_tag
-
-		time = str(util.timedelta(seconds=int(item['time'])))
-		time = urwid.AttrMap(urwid.Text(time, wrap='clip', align='left'), 'time')
-		time = ('fixed', 6, time)
-
-		artist = urwid.AttrMap(urwid.Text(item['artist'], wrap='clip'), 'artist')
-		artist = ('weight', 1.0, artist)
-
-		title = urwid.AttrMap(urwid.Text(item['title'], wrap='clip'), 'title')
-		title = ('weight', 1.5, title)
-
-		album = urwid.AttrMap(urwid.Text(item['album'], wrap='clip', align='right'), 'album')
-		album = ('weight', 1.0, album)
-
-		item = urwid.Columns((time, artist, title, album))
-
-		return urwid.AttrMap(
-			item,
-			{
-				'time': 'playlist.time',
-				'artist': 'playlist.artist',
-				'title': 'playlist.title',
-				'album': 'playlist.album',
-			},
-			{
-				'time': 'playlist.time.focus',
-				'artist': 'playlist.artist.focus',
-				'title': 'playlist.title.focus',
-				'album': 'playlist.album.focus',
-			},
-		)
+	def _forget(self, item):
+		for selected in (False, True):
+			self._formatcache.pop((item['id'], 'file' in item, selected))
 
-	def set_focus(self, focus):
-		super(NowPlayingWalker, self).set_focus(focus)
-		if focus in self.items:
-			urwid.emit_signal(self, 'change', self.items[focus])
+	def _resync(self):
+		"""Throws away the local copy, i.e. after tags changed in the database."""
+		self._version = None
+		self._formatcache.clear()
+		return self._reload()
 
-	def play_current(self):
-		item = super(NowPlayingWalker, self)._get_raw(self.focus)
-		if item is None:
+	def _update_items(self):
+		"""Applies only what changed since the last known playlist version.
+
+		plchangesposid tells us where every moved or new song now lives, which
+		is all the QueueWindow needs; tags are fetched when rows are shown.
+		Consume mode or a reorder therefore costs next to nothing."""
+		# Our own edits go first, they are already part of self.items.
+		self._send_edits()
+		# Status first: anything changing in between is simply applied twice.
+		status = self.mpc.state.status
+		self._sync(status['playlist'], int(status['playlistlength']))
+
+	def _sync(self, version, length, full=False):
+		"""Brings self.items to playlist version, from the last known one or
+		if full, from scratch but keeping the tags we have."""
+		if version == self._version:
 			return
-		self.mpc.playid(item['id'])
+		since = self._version
+		if since is None:
+			self.items.clear()
+		if since is None or full:
+			since = 0 # Older than anything, i.e. the whole playlist.
+		if not self.items.apply_changes(self.mpc.plchangesposid(since), length):
+			self.items.apply_changes(self.mpc.plchangesposid(0), length)
+		self._version = version
 
-	def delete_current(self):
-		item = super(NowPlayingWalker, self)._get_raw(self.focus)
-		if item is None:
+	def _edit(self, command, *args):
+		"""Queues an edit that was already applied to self.items.
+		Moving the same song again and again leaves a single moveid."""
+		edit = (command,) + args
+		if command == 'moveid' and self._edits and self._edits[-1][:2] == edit[:2]:
+			self._edits[-1] = edit
+		else:
+			self._edits.append(edit)
+		self.mpc.throttle('playlist', self._send_edits)
+
+	def _send_edits(self):
+		"""Sends queued edits in one command list between two status calls.
+
+		If the first status still shows the version we edited, nobody else
+		got in between and self.items already is what MPD ends up with. If
+		someone did, their changes are merged in from plchangesposid. Should
+		an edit fail, MPD drops the rest of the list and positions are
+		fetched anew."""
+		if not self._edits:
 			return
+		edits, self._edits = self._edits, []
+		focus = self.focus
+		item = self._get_raw(focus)
 		try:
-			self.mpc.deleteid(item['id'])
+			with self.mpc.batch() as batch:
+				batch.status()
+				for edit in edits:
+					getattr(batch, edit[0])(*edit[1:])
+				batch.status()
 		except mpd.CommandError as e:
-			self._reload()
+			pass # batch.results stays None.
+		# Whatever status was known before is out of date now.
+		self.mpc.state.invalidate()
+		if batch.results is None:
+			status = self.mpc.state.status
+			self._sync(status['playlist'], int(status['playlistlength']), True)
+		elif batch.results[0]['playlist'] == self._version:
+			self._version = batch.results[-1]['playlist']
+			return
+		else:
+			status = batch.results[-1]
+			self._sync(status['playlist'], int(status['playlistlength']))
+		self._restore_focus(focus, item)
 
-	def swap_down(self):
-		f = self.focus
-		this, below = self._get_raw(f), self._get_raw(f+1)
-		if this is None or below is None:
+	def _format(self, item):
+		if 'file' not in item:
+			# Tags are on their way, see QueueWindow.
+			return PlaylistRow('', '', config.format.playlist.loading, '',
+			                   self._is_selected(item['id']))
+		return PlaylistRow.of(item, self._is_selected(item['id']))
+
+	def play_current(self):
+		item = super(NowPlayingWalker, self)._get_raw(self.focus)
+		if item is None:
 			return
-		this, below = this['id'], below['id']
-		self.items[f], self.items[f+1] = self.items[f+1], self.items[f]
-		self.focus += 1
-		self.mpc.swapid(this, below)
+		self.mpc.playid(item['id'])
+
+	def swap_down(self):
+		self._move_current(1)
 
 	def swap_up(self):
+		self._move_current(-1)
+
+	def _move_current(self, offset):
 		f = self.focus
-		this, above = self._get_raw(f), self._get_raw(f-1)
-		if this is None or above is None:
+		item, other = self._get_raw(f), self._get_raw(f + offset)
+		if item is None or other is None:
 			return
-		this, above = this['id'], above['id']
-		self.items[f], self.items[f-1] = self.items[f-1], self.items[f]
-		self.focus -= 1
-		self.mpc.swapid(this, above)
+		self.items.move(f, f + offset)
+		self.set_focus(f + offset)
+		self._edit('moveid', item['id'], f + offset)
 
 	def focus_playing(self):
-		status = self.mpc.status()
+		status = self.mpc.state.status
 		if 'song' in status and status['state'] != 'stop':
 			self.set_focus(int(status['song']))
 
+	## Selection. Bulk edits work on it, or on the focus if there is none.
+
+	def set_focus(self, focus):
+		self.focus = focus
+		self._update_range()
+		self._modified()
+
+	def _is_selected(self, songid):
+		return songid in self._tagged or songid in self._range
+
+	def selection(self):
+		"""Positions of selected songs, in order."""
+		ids = self.items.ids
+		if not self._tagged and not self._range:
+			return [self.focus] if self.focus < len(ids) else []
+		return [pos for pos, songid in enumerate(ids) if self._is_selected(songid)]
+
+	def toggle_selected(self):
+		"""Tags or untags the focused song and moves on to the next."""
+		item = self._get_raw(self.focus)
+		if item is None:
+			return
+		self._tagged.symmetric_difference_update([item['id']])
+		if self.focus + 1 < len(self.items):
+			self.set_focus(self.focus + 1)
+		else:
+			self._modified()
+
+	def toggle_range(self):
+		"""Starts selecting from the focus on, or keeps what was selected."""
+		if self._anchor is None:
+			item = self._get_raw(self.focus)
+			if item is not None:
+				self._anchor = item['id']
+		else:
+			self._tagged |= self._range
+			self._anchor = None
+		self._update_range()
+		self._modified()
+
+	def clear_selection(self):
+		self._tagged = set()
+		self._anchor = None
+		self._update_range()
+		self._modified()
+
+	def _update_range(self):
+		"""Selects what lies between the anchor and the focus."""
+		self._range = set()
+		if self._anchor is None:
+			return
+		ids = self.items.ids
+		try:
+			anchor = ids.index(self._anchor)
+		except ValueError as e:
+			self._anchor = None # Deleted meanwhile.
+			return
+		start, end = sorted((anchor, self.focus))
+		self._range = set(ids[start:end + 1])
+
+	def delete_selected(self):
+		"""Deletes the selection with one delete START:END per run."""
+		positions = self.selection()
+		if not positions:
+			return
+		chosen = set(positions)
+		ids = [songid for pos, songid in enumerate(self.items.ids)
+		       if pos not in chosen]
+		self._bulk_edit(ids, [('delete', '%d:%d' % run)
+		                      for run in reversed(util.ranges(positions))])
+
+	def crop(self):
+		"""Deletes everything but the selection."""
+		chosen = set(self.selection())
+		rest = [pos for pos in xrange(len(self.items)) if pos not in chosen]
+		if not chosen or not rest:
+			return
+		ids = [songid for pos, songid in enumerate(self.items.ids)
+		       if pos in chosen]
+		self._bulk_edit(ids, [('delete', '%d:%d' % run)
+		                      for run in reversed(util.ranges(rest))])
+
+	def move_selected(self):
+		"""Moves the selection, in order, to just above the focused song.
+
+		Each run is a single move START:END TO. Runs above the focus go
+		from the last one up, those below from the first one down; that way
+		no run shifts another that is still to be moved."""
+		if not self._tagged and not self._range:
+			return
+		positions = self.selection()
+		chosen = set(positions)
+		# The first unselected song from the focus on stays put.
+		anchor = self.focus
+		while anchor in chosen:
+			anchor += 1
+		ids = self.items.ids
+		ids = ([songid for songid in ids[:anchor] if not self._is_selected(songid)] +
+		       [ids[pos] for pos in positions] +
+		       [songid for songid in ids[anchor:] if not self._is_selected(songid)])
+
+		runs = util.ranges(positions)
+		above = [run for run in runs if run[0] < anchor]
+		below = [run for run in runs if run[0] > anchor]
+		commands = []
+		to = anchor
+		for start, end in reversed(above):
+			to -= end - start
+			if start != to:
+				commands.append(('move', '%d:%d' % (start, end), to))
+		to = anchor # Moving runs from above left it where it was.
+		for start, end in below:
+			commands.append(('move', '%d:%d' % (start, end), to))
+			to += end - start
+		self._bulk_edit(ids, commands)
+
+	## Reordering the whole playlist.
+
+	def sort(self):
+		"""Sorts the playlist by the tags in config.playlist.sort_by. Songs
+		alike stay in the order they were in."""
+		tags = config.playlist.sort_by
+		collate = sort_key()
+		def key(song):
+			values = []
+			for tag in tags:
+				value = song.get(tag, '')
+				if isinstance(value, list):
+					value = ''.join(value)
+				if tag in ('track', 'disc'):
+					# "3/12" and "03" both come before "10".
+					number = value.split('/')[0].strip()
+					values.append((int(number), '') if number.isdigit()
+					              else (None, value.lower()))
+				else:
+					values.append(collate(value))
+			return values
+		self._reorder(lambda songs: [song['id'] for song in sorted(songs, key=key)])
+
+	def dedupe(self):
+		"""Deletes songs whose file is in the playlist before, but never the
+		one playing; its earlier copies go instead."""
+		def keep(songs):
+			status = self.mpc.state.status
+			playing = status.get('songid') if status['state'] != 'stop' else None
+			first = {}
+			for song in songs:
+				if song['file'] not in first or song['id'] == playing:
+					first[song['file']] = song['id']
+			ids = set(first.itervalues())
+			return [song['id'] for song in songs if song['id'] in ids]
+		self._reorder(keep)
+
+	def _reorder(self, order):
+		"""Fetches tags of the whole playlist, has order(songs) return the ids
+		to keep in their new order, and gets MPD there in one command list.
+
+		Songs to drop go first, a delete START:END per run. Of the rest,
+		those already in the right order relative to each other stay; only
+		the others are moved with moveid, which is as few as it gets."""
+		self._send_edits()
+		def arrived(songs):
+			current = [song['id'] for song in songs]
+			if current != self.items.ids or self._edits:
+				signals.emit('user_notification',
+				             'Playlist changed meanwhile, not reordered')
+				return
+			ids = order(songs)
+			keep = set(ids)
+			drop = [pos for pos, songid in enumerate(current) if songid not in keep]
+			commands = [('delete', '%d:%d' % run)
+			            for run in reversed(util.ranges(drop))]
+			rest = [songid for songid in current if songid in keep]
+			moves = util.move_plan(rest, ids)
+			commands.extend(('moveid', songid, to) for songid, to in moves)
+			self._bulk_edit(ids, commands)
+			signals.emit('user_notification', 'Playlist reordered: %d moved, %d deleted'
+			             % (len(moves), len(drop)))
+		self.mpc.request('playlistinfo', callback=arrived, timeout=0)
+
+	def _bulk_edit(self, ids, commands):
+		"""Shows ids as the new playlist and has commands, which get MPD
+		there, sent in one go. The selection is done with."""
+		focus = self.focus
+		item = self._get_raw(focus)
+		self.items.replace(ids)
+		self._tagged = set()
+		self._anchor = None
+		self._range = set()
+		self._restore_focus(focus, item)
+		if commands:
+			self._edits.extend(commands)
+			self.mpc.throttle('playlist', self._send_edits)
+
+class SearchWalker(IOWalker):
+	"""Songs matching a query, from a search.SearchIndex.
+
+	Results are only looked for as far as they are shown, so unlike other
+	walkers this one never counts its items; when results change the focus
+	keeps its position rather than following a song."""
+	query = ''
+
+	def __init__(self, mpc, index):
+		self.mpc = mpc
+		self.index = index
+		self._songs = index.songs # Whose widgets are in the cache.
+		super(SearchWalker, self).__init__(index.search(self.query))
+		signals.listen('search_index_changed', self._reload)
+
+	def search(self, query):
+		self.query = query
+		self.focus = 0
+		self._reload()
+
+	def _reload(self):
+		if self.index.songs is not self._songs:
+			# Built anew, tags may have changed.
+			self._formatcache.clear()
+			self._songs = self.index.songs
+		self.items = self.index.search(self.query)
+		if self._get_raw(self.focus) is None:
+			self.focus = 0
+		self._modified()
+		return True
+
+	def _cache_key(self, item):
+		return item.file
+
+	def _format(self, item):
+		return PlaylistRow.of(item)
+
+	def play_current(self):
+		song_id = self.queue_current()
+		if song_id is not None:
+			self.mpc.playid(song_id)
+
+	def queue_current(self):
+		item = self._get_raw(self.focus)
+		if item is None:
+			return None
+		try:
+			song_id = self.mpc.addid(item.file)
+		except mpd.CommandError as e:
+			return None # Gone from the database since we indexed it.
+		signals.emit('user_notification', 'Adding "%s" by %s' % (
+			item.get('title', item.file), item.get('artist', config.format.empty_tag)))
+		return song_id
+
+	def queue_all(self):
+		"""Adds every song found, in as few command lists as possible."""
+		if not self.query.strip():
+			return
+		try:
+			count = self.mpc.enqueue_files(song.file for song in self.items)
+		except (mpd.CommandError, mpd.ConnectionError) as e:
+			signals.emit('user_notification', str(e))
+			return
+		signals.emit('user_notification', 'Added %d songs' % count)
+
 class HelpPanelWalker(IOWalker):
 	def _get_items(self):
 		# Get (section, action) combinations for _format to use.
@@ -393,3 +1790,39 @@ class HelpPanelWalker(IOWalker):
 		              ' ', ('help.key', str(key))]
 		return urwid.Text(actionline)
 
+
+if __name__ == '__main__':
+	# Render benchmark: scrolling a full screen playlist, PlaylistRow against
+	# the AttrMap(Columns([AttrMap(Text)...])) rows it replaced.
+	import sys
+	import gc
+	import time
+	urwid.set_encoding('utf8')
+	cols, rows = 160, 50
+	frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	def columns_row(*text):
+		parts = []
+		for name, value in zip(PlaylistRow.fields, text):
+			align = 'right' if name == 'album' else 'left'
+			parts.append(urwid.AttrMap(urwid.Text(value, wrap='clip', align=align), name))
+		parts = [('fixed', 6, parts[0]), ('weight', 1.0, parts[1]),
+		         ('weight', 1.5, parts[2]), ('weight', 1.0, parts[3])]
+		return urwid.AttrMap(urwid.Columns(parts),
+			dict((name, 'playlist.' + name) for name in PlaylistRow.fields),
+			dict((name, 'playlist.%s.focus' % name) for name in PlaylistRow.fields))
+	songs = [('%d:%02d' % (3 + n % 3, n % 60), 'Artist %d' % (n // 100),
+	          'Title of song number %d' % n, 'Album %d' % (n // 10))
+	         for n in xrange((frames + 1) * rows)]
+	print '%dx%d screen, %d frames' % (cols, rows, frames)
+	for key in ('down', 'page down'):
+		for name, make in (('Columns', columns_row), ('PlaylistRow', PlaylistRow)):
+			listbox = urwid.ListBox(urwid.SimpleListWalker([make(*s) for s in songs]))
+			shown = listbox.render((cols, rows), focus=True)
+			gc.collect()
+			start = time.time()
+			for frame in xrange(frames):
+				listbox.keypress((cols, rows), key)
+				# Like the screen, hold on to the last canvas while drawing the next.
+				shown = listbox.render((cols, rows), focus=True)
+			took = time.time() - start
+			print '%-9s %-11s %6.3f ms/frame' % (key, name, took * 1000 / frames)
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import urwid
 
+import signals
 import ui_lists
 import ui_status
 import util
+import library
+import search
 import configuration
 from configuration import config
 
@@ -32,19 +35,32 @@ class MainFrame(urwid.Frame):
 			'library_panel': lambda _: self.get_body().switch('library'),
 			'playlist_panel': lambda _: self.get_body().switch('playlist'),
 			'help_panel': lambda _: self.get_body().switch('help'),
+			'search_panel': lambda _: self.get_body().switch('search'),
+			'browser_panel': lambda _: self.get_body().switch('browser'),
+			'playlists_panel': lambda _: self.get_body().switch('playlists'),
 			'toggle_panels': lambda _: self.toggle_panel(),
+			'show_stats': lambda _: self.show_stats(),
 			'exit': lambda _: self.quit(),
 		}
 
 		self.keymap = configuration.KeyMapper(self.actionmap, config.keymap.globals)
 
-		self.librarypanel = LibraryPanel(mpc)
+		if config.library.layout == 'tree':
+			self.librarypanel = LibraryTreePanel(mpc)
+		else:
+			self.librarypanel = LibraryPanel(mpc)
 		self.nowplayingpanel = NowPlayingPanel(mpc)
 		self.helppanel = HelpPanel()
+		self.searchpanel = SearchPanel(mpc, self.librarypanel.model)
+		self.browserpanel = BrowserPanel(mpc)
+		self.playlistspanel = StoredPlaylistsPanel(mpc)
 		self.panel_dict = {
 			'library': self.librarypanel,
 			'playlist': self.nowplayingpanel,
 			'help': self.helppanel,
+			'search': self.searchpanel,
+			'browser': self.browserpanel,
+			'playlists': self.playlistspanel,
 		}
 
 		body = util.WidgetMux(self.panel_dict, 'library')
@@ -68,6 +84,17 @@ class MainFrame(urwid.Frame):
 			index = 0
 		self.get_body().switch(panels[index])
 
+	def show_stats(self):
+		"""Tells how many redraws were asked for and how many were done, how
+		well the query cache does and how much the library model holds."""
+		requested, performed = signals.draw_stats()
+		message = 'Redraws: %d asked for, %d done' % (requested, performed)
+		if self.mpc.cache is not None:
+			message += ('; query cache: %(entries)d entries, %(hits)d hits, '
+			            '%(misses)d misses' % self.mpc.cache.stats())
+		message += '; library: %d KB' % (self.librarypanel.model.memory() // 1024)
+		signals.emit('user_notification', message, 5.0)
+
 	def quit(self):
 		raise urwid.ExitMainLoop()
 
@@ -76,10 +103,17 @@ class NowPlayingPanel(ui_lists.TreeList):
 		super(NowPlayingPanel, self).__init__(ui_lists.NowPlayingWalker(mpc))
 		actionmap = {
 			'play': lambda _: self.body.play_current(),
-			'delete': lambda _: self.body.delete_current(),
+			'delete': lambda _: self.body.delete_selected(),
 			'swap_below': lambda _: self.body.swap_down(),
 			'swap_above': lambda _: self.body.swap_up(),
 			'focus_current': lambda _: self.body.focus_playing(),
+			'select': lambda _: self.body.toggle_selected(),
+			'select_range': lambda _: self.body.toggle_range(),
+			'clear_selection': lambda _: self.body.clear_selection(),
+			'move_selection': lambda _: self.body.move_selected(),
+			'crop': lambda _: self.body.crop(),
+			'sort': lambda _: self.body.sort(),
+			'dedupe': lambda _: self.body.dedupe(),
 		}
 		self.keymap.update(actionmap, config.keymap.now_playing)
 
@@ -87,18 +121,21 @@ class LibraryPanel(urwid.Columns):
 	def __init__(self, mpc):
 		self.mpc = mpc
 
-		artist_walker = ui_lists.ArtistWalker(mpc)
+		self.model = library.LibraryModel(mpc)
+
+		artist_walker = ui_lists.ArtistWalker(mpc, self.model)
 		artists = ui_lists.PlayableList(artist_walker)
 
-		album_walker = ui_lists.AlbumWalker(mpc, None)
+		album_walker = ui_lists.AlbumWalker(mpc, None, self.model)
 		albums = ui_lists.PlayableList(album_walker)
 
-		track_walker = ui_lists.TrackWalker(mpc, None, None)
+		track_walker = ui_lists.TrackWalker(mpc, None, None, self.model)
 		tracks = ui_lists.PlayableList(track_walker)
 
 		urwid.connect_signal(artist_walker, 'change', album_walker.change_artist)
 		urwid.connect_signal(album_walker, 'change', track_walker.change_album)
-		artist_walker.set_focus(artist_walker.focus) # Force a change event
+		# Force a change event, in case the artists arrived before we connected.
+		artist_walker.set_focus(artist_walker.focus)
 
 		self.artists = artists
 		self.albums = albums
@@ -113,6 +150,96 @@ class LibraryPanel(urwid.Columns):
 		wlist = artists, ('fixed', divlen, div1), albums, ('fixed', divlen, div2), tracks
 		super(LibraryPanel, self).__init__(wlist)
 
+class LibraryTreePanel(ui_lists.PlayableList):
+	"""The library as one tree, expanded as far as you go, in place of
+	LibraryPanel's columns."""
+	def __init__(self, mpc):
+		self.mpc = mpc
+		self.model = library.LibraryModel(mpc)
+		super(LibraryTreePanel, self).__init__(ui_lists.LibraryTreeWalker(mpc, self.model))
+		actionmap = {
+			'expand': lambda _: self.body.expand(),
+			'collapse': lambda _: self.body.collapse(),
+		}
+		self.keymap.update(actionmap, config.keymap.library_tree)
+
+class StoredPlaylistsPanel(urwid.Columns):
+	"""Stored playlists on the left, the focused one's songs on the right."""
+	def __init__(self, mpc):
+		self.mpc = mpc
+		playlist_walker = ui_lists.StoredPlaylistWalker(mpc)
+		contents_walker = ui_lists.PlaylistContentsWalker(mpc)
+		self.playlists = ui_lists.PlayableList(playlist_walker)
+		self.songs = ui_lists.PlayableList(contents_walker)
+
+		urwid.connect_signal(playlist_walker, 'change', contents_walker.change_playlist)
+		urwid.connect_signal(playlist_walker, 'stale', contents_walker.playlists_changed)
+		playlist_walker.set_focus(playlist_walker.focus)
+
+		attr = 'library.vdivider'
+		divstr = config.format.library.vdivider
+		divlen = len(divstr.decode('utf-8'))
+		div = urwid.AttrWrap(util.VDivider(divstr), attr, attr)
+
+		wlist = self.playlists, ('fixed', divlen, div), ('weight', 3, self.songs)
+		super(StoredPlaylistsPanel, self).__init__(wlist)
+
+class SearchPanel(urwid.Frame):
+	"""A query line above the songs matching it, which refine as you type.
+	Keys the query line has no use for go to the list."""
+	def __init__(self, mpc, model=None):
+		self.index = search.SearchIndex(mpc, model)
+		self.walker = ui_lists.SearchWalker(mpc, self.index)
+		self.list = ui_lists.PlayableList(self.walker)
+		self.edit = urwid.Edit(('search.prompt', 'Search: '))
+		urwid.connect_signal(self.edit, 'change',
+		                     lambda edit, text: self.walker.search(text))
+		actionmap = {
+			'queue': lambda _: self.walker.queue_current() and None,
+			'queue_all': lambda _: self.walker.queue_all(),
+			'clear': lambda _: self.edit.set_edit_text(''),
+		}
+		self.keymap = configuration.KeyMapper(actionmap, config.keymap.search)
+		super(SearchPanel, self).__init__(self.list, header=self.edit,
+		                                  focus_part='header')
+
+	def shown(self):
+		# The index is built the first time it is needed.
+		self.index.load()
+
+	def render(self, size, focus=False):
+		maxcol, maxrow = size
+		header = self.header.render((maxcol,), focus)
+		# The list shows its focus too, while the cursor stays in the query.
+		body = self.body.render((maxcol, maxrow - header.rows()), focus)
+		return urwid.CanvasCombine([(header, None, True), (body, None, False)])
+
+	def keypress(self, size, key):
+		if key in self.keymap:
+			return self.keymap(size, key)
+		maxcol, maxrow = size
+		key = self.header.keypress((maxcol,), key)
+		if key is not None:
+			key = self.body.keypress((maxcol, maxrow - self.header.rows((maxcol,))), key)
+		return key
+
+class BrowserPanel(urwid.Frame):
+	"""The music directory, browsed one directory at a time below its path."""
+	def __init__(self, mpc):
+		self.walker = ui_lists.DirectoryWalker(mpc)
+		self.list = ui_lists.PlayableList(self.walker)
+		actionmap = {
+			'open': lambda _: self.walker.open_current(),
+			'parent': lambda _: self.walker.open_parent(),
+		}
+		self.list.keymap.update(actionmap, config.keymap.browser)
+		self.path = urwid.Text('', wrap='clip')
+		urwid.connect_signal(self.walker, 'change',
+		                     lambda path: self.path.set_text('/' + path))
+		self.path.set_text('/' + self.walker.path)
+		header = urwid.AttrMap(self.path, 'browser.path')
+		super(BrowserPanel, self).__init__(self.list, header=header)
+
 class HelpPanel(urwid.Frame):
 	def __init__(self):
 		header = urwid.Text([('help.header', 'Current keybindings'),
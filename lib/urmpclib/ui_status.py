@@ -58,60 +58,84 @@ class ProgressBar_(urwid.ProgressBar):
 		return Text( str(percent)+" %", 'center', 'clip' )
 
 class CurrentSongProgress(ProgressBar_):
+	"""Shows elapsed/total time of the current song.
+
+	MPD is only asked on player events. In between, elapsed time is advanced
+	locally from a monotonic clock, so ticking costs no network traffic."""
+	_progress_alarm = None
+	_state = 'stop'
+	_seed = 0.0 # Elapsed seconds reported by MPD...
+	_seeded_at = 0.0 # ...and util.monotonic() at that moment.
+
 	def __init__(self, mpc, *args, **kwargs):
 		super(CurrentSongProgress, self).__init__(*args, **kwargs)
 		self.mpc = mpc
+		self._precision = int(config.format.progress.precision)
+		self._interval = 10.0 ** -self._precision
 		signals.listen('idle_player', self._player_update)
+		signals.listen('seek_pending', self._player_update)
 		self._player_update()
 
 	def get_text(self):
-		if self._stopped is True:
+		if self._state == 'stop':
 			return urwid.Text('[Stopped]', 'right', 'clip')
 
 		done = str(util.timedelta(seconds=self.done))
-		current = str(util.timedelta(seconds=self.current))
+		current = str(util.timedelta(seconds=int(self.current)))
+		if self._precision > 0:
+			fraction = int(self.current % 1 * 10 ** self._precision)
+			current += '.' + str(fraction).zfill(self._precision)
 
 		#TODO: config align, format
 		text = "%s/%s"
-		if self.mpc.status()['state'] == 'pause':
+		if self._state == 'pause':
 			text = '[Paused] ' + text
 		text = urwid.Text(text % (current, done), 'right', 'clip')
 		return text
 
-	_progress_alarm = None
-	_stopped = False
+	def _elapsed(self):
+		"""Where playback should be by now, without asking MPD."""
+		elapsed = self._seed
+		if self._state == 'play':
+			elapsed += util.monotonic() - self._seeded_at
+		return min(elapsed, self.done)
+
 	def _player_update(self):
 		"""Indicates that new song, pause, etc. more important than seconds++
 		has happened."""
-		status = self.mpc.status()
-		if status['state'] == 'stop':
-			self._stopped = True
+		state = self.mpc.state
+		status = state.status
+		self._state = status['state']
+		if self._progress_alarm is not None:
+			signals.alarm_remove(self._progress_alarm)
+			self._progress_alarm = None
+
+		if self._state == 'stop':
 			self.set_completion(0)
 			self.set_finished(100) # Can't be 0, ZeroDivisionError in urwid.
-			if self._progress_alarm is not None:
-				signals.alarm_remove(self._progress_alarm)
-				self._progress_alarm = None
 			return True
-		self._stopped = False
 
 		# Something changed, better recalculate.
 		assert 'time' in status # If we're not stopped, we must be on a track
-		current, done = map(int, status['time'].split(':'))
-		self.set_completion(current)
-		self.set_finished(done)
+		done = int(status['time'].split(':')[1])
+		self._seed = state.elapsed()
+		self._seeded_at = util.monotonic()
+		self.set_finished(max(done, 1))
+		self.set_completion(self._elapsed())
 
 		signals.redraw()
 
-		if self._progress_alarm is not None:
-			signals.alarm_remove(self._progress_alarm)
-			self._progress_alarm = None
-			
-		if status['state'] == 'play':
-			self._progress_alarm = signals.alarm_in(1.0, self._progress_increment)
+		if self._state == 'play':
+			self._schedule_tick()
+
+	def _schedule_tick(self):
+		"""Wakes up when the displayed time is due to change next."""
+		delay = self._interval - self._elapsed() % self._interval
+		self._progress_alarm = signals.alarm_in(delay, self._progress_increment)
 
 	def _progress_increment(self, *_):
-		self._progress_alarm = signals.alarm_in(1.0, self._progress_increment)
-		self.set_completion(self.current+1)
+		self._schedule_tick()
+		self.set_completion(self._elapsed())
 		signals.redraw()
 
 class MainFooter(util.WidgetMux):
@@ -155,15 +179,17 @@ class MainFooter(util.WidgetMux):
 		return False
 
 	def _notify_update(self):
-		if 'updating_db' not in self.mpc.status():
+		if 'updating_db' not in self.mpc.state.status:
 			signals.emit('user_notification', 'Database update finished!')
 		# else: update ongoing, ignore
 
 	def _playlist_update(self):
-		if int(self.mpc.status()['playlistlength']) == 0:
+		if int(self.mpc.state.status['playlistlength']) == 0:
 			signals.emit('user_notification', 'Cleared playlist!')
 
 class CurrentSong(urwid.Text):
+	_version = None # StatusModel.version last displayed.
+
 	def __init__(self, mpc):
 		self.mpc = mpc
 		super(CurrentSong, self).__init__('', wrap='clip')
@@ -171,15 +197,17 @@ class CurrentSong(urwid.Text):
 		self._player_update()
 
 	def _player_update(self):
-		if self.mpc.status()['state'] == 'stop':
-			self.set_text('')
-			return True
-
-		item = self.mpc.currentsong()
-		if 'artist' not in item: item['artist'] = config.format.empty_tag
-		if 'title' not in item: item['title'] = config.format.empty_tag
-
-		self.set_text('%s: %s' % (item['artist'], item['title']))
+		state = self.mpc.state
+		if state.status['state'] == 'stop':
+			text = ''
+		else:
+			item = state.song
+			empty = config.format.empty_tag
+			text = '%s: %s' % (item.get('artist', empty), item.get('title', empty))
+		if state.version == self._version:
+			return False
+		self._version = state.version
+		self.set_text(text)
 		return True
 
 class DaemonFlags(urwid.Text):
@@ -203,7 +231,7 @@ class DaemonFlags(urwid.Text):
 
 	def _get_flags(self):
 		flags = {}
-		status = self.mpc.status()
+		status = self.mpc.state.status
 		flags['Repeat'] = status['repeat'] == '1'
 		flags['Random'] = status['random'] == '1'
 		flags['Single'] = status['single'] == '1'
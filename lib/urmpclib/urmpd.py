@@ -1,8 +1,14 @@
+import os
 import socket
+import marshal
+import threading
+import collections
+import Queue
 import mpd
 import urwid
 
 import signals
+import util
 from configuration import config
 
 # See http://www.musicpd.org/doc/protocol/ch03.html
@@ -25,22 +31,137 @@ idle_events = (
 	                   # or deleted
 )
 
+class StatusModel(object):
+	"""Shared copy of status() and currentsong().
+
+	Both are fetched lazily and at most once per idle batch: Idler calls
+	invalidate() before emitting its events, and widgets and actions read
+	from here instead of asking MPD themselves.
+	version increases whenever the fetched data differ from what we had, so
+	consumers can remember it and skip work when nothing changed."""
+
+	# Keys that change on every fetch while playing; they don't bump version.
+	_volatile = frozenset(('time', 'elapsed', 'bitrate', 'audio'))
+
+	version = 0
+	fetches = 0 # Round trips made...
+	saved = 0 # ...and round trips avoided.
+
+	def __init__(self, mpc):
+		self._mpc = mpc
+		self._status = None
+		self._song = None
+		self._last_status = {}
+		self._last_song = {}
+		self._fetched_at = 0.0
+
+	def invalidate(self):
+		"""Forgets everything, the next read goes to MPD."""
+		self._status = None
+		self._song = None
+
+	@property
+	def status(self):
+		if self._status is None:
+			self.fetches += 1
+			self._status = self._mpc.status()
+			self._fetched_at = util.monotonic()
+			old = self._last_status
+			new = self._status
+			if set(old) ^ set(new) or any(old[k] != new[k] for k in new
+			                              if k not in self._volatile):
+				self.version += 1
+			self._last_status = new
+		else:
+			self.saved += 1
+		return self._status
+
+	@property
+	def song(self):
+		"""The current song, {} when there is none."""
+		if self._song is None:
+			self.fetches += 1
+			self._song = self._mpc.currentsong()
+			if self._song != self._last_song:
+				self.version += 1
+			self._last_song = self._song
+		else:
+			self.saved += 1
+		return self._song
+
+	def update(self, **changes):
+		"""Applies the expected outcome of a command we just sent, so repeated
+		actions don't act on stale data before MPD reports back."""
+		status = self.status
+		changes = dict((k, str(v)) for k, v in changes.items())
+		if 'elapsed' in changes:
+			self._fetched_at = util.monotonic() # As of now.
+		if any(status.get(k) != v for k, v in changes.items()
+		       if k not in self._volatile):
+			self.version += 1
+		status.update(changes)
+
+	def elapsed(self):
+		"""Seconds into the current song, advanced locally while playing."""
+		status = self.status
+		if 'time' not in status:
+			return 0.0
+		# 'elapsed' has millisecond resolution, 'time' only whole seconds.
+		elapsed = float(status.get('elapsed', status['time'].split(':')[0]))
+		if status['state'] == 'play':
+			elapsed += util.monotonic() - self._fetched_at
+		return elapsed
+
+_missing = object() # Tells a cache miss from a cached None.
+_snapshot_format = 1 # Bump when save_cache() output changes.
+
 class MPDClient(mpd.MPDClient):
 	"""Used just like the normal MPDClient. It takes care of reconnecting
 	to MPD when the connection drops out."""
 
 	# Holds server address
 	_host_port = None, None
-	
-	def connect(self, host, port):
+	# Seconds a blocking socket operation may take, None waits forever.
+	_timeout = None
+	# Runs request()s, created on first use.
+	_background = None
+	_prefetcher = None # Same, for request(..., prefetch=True).
+	# Keeps results of request(..., cache=True), see enable_cache().
+	cache = None
+	_cache_stamp = None # stats()['db_update'] the cached results belong to.
+	_cache_generation = 0 # Bumped whenever they are thrown away.
+
+	def __init__(self):
+		super(MPDClient, self).__init__()
+		self.state = StatusModel(self)
+		self._held = {} # {name: [alarm, send]}, see throttle().
+		self._seek = None # Pending (seconds into current song, as of when).
+		self._volume = None # Pending volume.
+
+	def connect(self, host, port, timeout=None):
 		"""See mpd.MPDClient.connect(). You only _need_ to call this once."""
 		self._host_port = host, port
+		self._timeout = timeout
 		self._connect()
 
 	def _connect(self):
 		"""Forcefully kills the connection and opens it again."""
 		super(MPDClient, self)._reset()
 		super(MPDClient, self).connect(*self._host_port)
+		if self.cache is not None:
+			# Any idle_database while we were gone went unnoticed.
+			stats = super(MPDClient, self).__getattr__('stats')()
+			self.validate_cache(stats['db_update'])
+
+	# python-mpd has no notion of timeouts, so its sockets get ours here.
+	# socket.setdefaulttimeout() would do for every thread at once.
+	def _connect_tcp(self, host, port):
+		return socket.create_connection((host, port), self._timeout)
+
+	def _connect_unix(self, path):
+		sock = super(MPDClient, self)._connect_unix(path)
+		sock.settimeout(self._timeout)
+		return sock
 
 	def _connect_wrap(self, func):
 		"""Wraps an MPDClient function to reconnect if it drops out.
@@ -70,26 +191,203 @@ class MPDClient(mpd.MPDClient):
 		super(MPDClient, self).__getattr__('update')()
 		signals.emit('user_notification', 'Database update started!')
 
+	def request(self, command, *args, **kwargs):
+		"""Runs a command on a background connection without blocking the UI.
+
+		Returns a Request at once. When the result arrives, callback(result)
+		is called from the main loop; on failure or after timeout seconds
+		errback(exception) is instead, which by default notifies the user.
+		A timeout of 0 waits for as long as it takes.
+		With stream=N, callback gets lists of up to N entries as they are
+		read instead, and [] once the result is complete; huge results then
+		neither sit in memory twice nor hold up the UI while being parsed.
+		Keyword arguments: callback, errback, timeout, stream, cache, which
+		answers from and stores into self.cache if enabled, and prefetch,
+		which sends the command on a second connection kept for work nobody
+		waits for, so it never holds up the other requests.
+		Cached results are shared, so don't modify them."""
+		if kwargs.pop('cache', False) and self.cache is not None:
+			key = (command,) + args
+			result = self.cache.get(key, _missing)
+			callback = kwargs.get('callback')
+			if result is not _missing:
+				request = Request(command, args, callback, None)
+				request.result = result
+				request._finish()
+				return request
+			generation = self._cache_generation
+			def store(result):
+				if generation == self._cache_generation:
+					self.cache[key] = result
+				if callback is not None:
+					callback(result)
+			kwargs['callback'] = store
+		if kwargs.pop('prefetch', False):
+			if self._prefetcher is None:
+				self._prefetcher = BackgroundClient(self, 'urmpd-prefetch')
+			return self._prefetcher.request(command, args, **kwargs)
+		if self._background is None:
+			self._background = BackgroundClient(self)
+		return self._background.request(command, args, **kwargs)
+
+	def enable_cache(self, cache):
+		"""Keeps results of request(..., cache=True) in cache, a
+		cache.LRUCache, for as long as the database doesn't change."""
+		self.cache = cache
+		signals.listen('idle_database', self._database_changed)
+		# Queued ahead of anything that could be cached.
+		self.request('stats', callback=self._check_cache)
+
+	def validate_cache(self, db_update):
+		"""Drops cached results unless they belong to database version
+		db_update, as in stats()['db_update'].
+		Returns True if anything was dropped."""
+		if db_update == self._cache_stamp:
+			return False
+		stale = len(self.cache) > 0
+		self.cache.clear()
+		self._cache_generation += 1
+		self._cache_stamp = db_update
+		return stale
+
+	def save_cache(self, filename):
+		"""Writes cached results to filename for load_cache() to pick up
+		on the next start. Returns False if that failed."""
+		if self.cache is None or self._cache_stamp is None:
+			return False
+		data = _snapshot_format, self._host_port, self._cache_stamp, self.cache.items()
+		try:
+			with open(filename + '.tmp', 'wb') as f:
+				marshal.dump(data, f)
+			os.rename(filename + '.tmp', filename)
+		except (IOError, OSError) as e:
+			return False
+		return True
+
+	def load_cache(self, filename):
+		"""Fills the cache with what save_cache() wrote, if it came from the
+		same server. Call this right after enable_cache(): the contents are
+		trusted until the server says otherwise, and if it does, everybody
+		gets an idle_database to reload.
+		Returns True if anything was loaded."""
+		try:
+			with open(filename, 'rb') as f:
+				format, host_port, stamp, entries = marshal.load(f)
+		except (IOError, EOFError, ValueError, TypeError) as e:
+			return False # Missing, truncated or from another python.
+		if format != _snapshot_format or tuple(host_port) != self._host_port:
+			return False
+		for key, value in entries:
+			self.cache[key] = value
+		self._cache_stamp = stamp
+		return True
+
+	def _check_cache(self, stats):
+		if self.validate_cache(stats['db_update']):
+			signals.emit('idle_database')
+
+	def _database_changed(self):
+		self._cache_stamp = None # Whatever stats say, it's stale.
+		self.validate_cache(self.stats()['db_update'])
+
+	def batch(self):
+		"""Returns a CommandBatch to pipeline several commands in one trip."""
+		return CommandBatch(self)
+
+	def _send_batch(self, commands):
+		"""Sends [(command, args)] as one command list, returns the results.
+		Like any other call, the whole list is retried once on reconnect."""
+		if not commands:
+			return []
+		rawattr = super(MPDClient, self).__getattr__
+		def send():
+			# These two are plain methods, not dispatched through _commands.
+			mpd.MPDClient.command_list_ok_begin(self)
+			for command, args in commands:
+				rawattr(command)(*args)
+			try:
+				return mpd.MPDClient.command_list_end(self)
+			except mpd.CommandError as e:
+				# No telling how much of the list MPD has answered; start over.
+				self._connect()
+				raise
+		return self._connect_wrap(send)()
+
+	def enqueue(self, *query):
+		"""Adds every song matching a find query, e.g. ('artist', 'Foo').
+		MPD does all the work with findadd, no tags are sent our way.
+		Returns how many songs were added."""
+		with self.batch() as batch:
+			batch.findadd(*query)
+			batch.count(*query)
+		return int(batch.results[1]['songs'])
+
+	def enqueue_ids(self, *query):
+		"""Like enqueue(), but returns the ids of the added songs so one can
+		be played. Costs a list of file names and a single command list."""
+		ids = []
+		for chunk in self._chunks('addid', self.list('file', *query)):
+			with self.batch() as batch:
+				for f in chunk:
+					batch.addid(f)
+			ids.extend(batch.results)
+		return ids
+
+	def enqueue_files(self, files):
+		"""Adds files in as few command lists as MPD takes, returns how many."""
+		count = 0
+		for chunk in self._chunks('add', files):
+			with self.batch() as batch:
+				for f in chunk:
+					batch.add(f)
+			count += len(chunk)
+		return count
+
+	# MPD refuses command lists bigger than max_command_list_size, 2 MB by
+	# default; stay well under it in case of a server set lower.
+	command_list_bytes = 1024 * 1024
+
+	def _chunks(self, command, args):
+		"""Splits args into lists of `command arg` lines that each fit into
+		one command list, counting the bytes as they go over the wire."""
+		chunk, size = [], 0
+		for arg in args:
+			line = len('%s "%s"\n' % (command, mpd.escape(str(arg))))
+			if chunk and size + line > self.command_list_bytes:
+				yield chunk
+				chunk, size = [], 0
+			chunk.append(arg)
+			size += line
+		if chunk:
+			yield chunk
+
 	def playpause(self):
-		if self.status()['state'] == 'play':
+		if self.state.status['state'] == 'play':
 			self.pause()
+			self.state.update(state='pause')
 		else:
 			self.play()
+			self.state.update(state='play')
 
 	def toggle(self, name):
 		"""Returns a function to toggle the given MPD flag."""
 		# Get flag status, flip it, and send it back.
-		return lambda: self.__getattr__(name)((1, 0)[int(self.status()[name])])
+		def toggle():
+			value = (1, 0)[int(self.state.status[name])]
+			self.__getattr__(name)(value)
+			self.state.update(**{name: value})
+		return toggle
 
 	def toggle_crossfade(self):
 		# Really, 'xfade'? Four characters saved, good job!
-		value = int(self.status()['xfade'])
+		value = int(self.state.status['xfade'])
 		if value == 0:
 			value = int(config.mpd.crossfade)
 		else:
 			value = 0
 		# With inconsistency as the cherry on top.
 		self.crossfade(value)
+		self.state.update(xfade=value)
 
 	def volume_up(self):
 		vdiff = 1
@@ -98,12 +396,24 @@ class MPDClient(mpd.MPDClient):
 		vdiff = 1
 		self.volume_diff(int(config.mpd.volume_diff) * -1)
 	def volume_diff(self, diff):
-		level = diff + int(self.status()['volume'])
+		"""Changes volume by diff. Presses in quick succession add up and are
+		sent as one setvol, see throttle()."""
+		level = self._volume
+		if level is None:
+			level = int(self.state.status['volume'])
+		level += diff
 		if diff > 0:
 			level = min(level, 100)
 		else:
 			level = max(level, 0)
-		self.setvol(level)
+		self._volume = level
+		self.state.update(volume=level)
+		signals.emit('user_notification', 'Volume set to %d%%' % level)
+		self.throttle('volume', self._send_volume)
+
+	def _send_volume(self):
+		self.setvol(self._volume)
+		self._volume = None
 
 	def urseek(self, diff, absolute=False, percentage=False):
 		"""Seek to an absolute or relative position.
@@ -111,45 +421,288 @@ class MPDClient(mpd.MPDClient):
 		Be aware that we will gladly skip *over* track boundaries.
 		For example, if you are at 1:27 in a 1:30 song and ask to jump ahead 5
 		seconds, you will end up at 0:01 in the next song.
-		This is a feature, not a bug."""
-		# Query MPD
-		status = self.status()
-		try:
-			song = int(status['song'])
-		except KeyError as e:
+		This is a feature, not a bug.
+
+		Seeks in quick succession add up and are sent as one, see throttle().
+		Meanwhile the position they lead to is shown, if it's in this song."""
+		status = self.state.status
+		if 'song' not in status:
 			return # No song currently loaded.
-		now, total = map(int, self.status()['time'].split(':'))
+		total = int(status['time'].split(':')[1])
 
 		if percentage is True:
 			diff = diff * 0.01 * total
 
 		if absolute is False:
-			target = now + diff
+			target = self._seek_position() + diff
 		else:
 			target = diff
+		self._seek = target, util.monotonic()
+		if 0 <= target <= total:
+			self.state.update(elapsed=target)
+			signals.emit('seek_pending')
+		self.throttle('seek', self._send_seek)
 
-		if target > total:
+	def _seek_position(self):
+		"""Seconds into the current song, counting a seek not sent yet."""
+		if self._seek is None:
+			return self.state.elapsed()
+		target, when = self._seek
+		if self.state.status['state'] == 'play':
+			target += util.monotonic() - when
+		return target
+
+	def _send_seek(self):
+		"""Seeks to the pending position with a single seek, at the cost of a
+		playlistinfo per track boundary crossed."""
+		target = self._seek_position()
+		self._seek = None
+		status = self.state.status
+		if 'song' not in status:
+			return
+		song = int(status['song'])
+		total = int(status['time'].split(':')[1])
+
+		if status['random'] == '1' and not 0 <= target <= total:
+			# No telling which song is next, MPD has to skip for us.
+			if target > total:
+				self.next()
+				self.state.invalidate()
+				self._seek = target - total, util.monotonic()
+			elif song != 0:
+				self.previous()
+				self.state.invalidate()
+				total = int(self.state.status['time'].split(':')[1])
+				self._seek = total + target, util.monotonic()
+			if self._seek is not None:
+				self._send_seek()
+			return
+
+		length = int(status['playlistlength'])
+		while target > total and song + 1 < length:
 			target -= total
-			self.next()
-			self.urseek(target, True, False)
-		elif target < 0:
-			if song == 0:
-				return # No previous song
-			self.previous()
-			now, total = map(int, self.status()['time'].split(':'))
-			self.urseek(total+target, False, False)
-		else:
-			# Typical case
+			song += 1
+			total = int(self.playlistinfo(song)[0].get('time', 0))
+		while target < 0 and song > 0:
+			song -= 1
+			total = int(self.playlistinfo(song)[0].get('time', 0))
+			target += total
+		if target > total:
+			self.next() # Past the last song, do what MPD does there.
+			self.state.invalidate()
+		elif target >= 0:
 			self.seek(song, int(target))
+			if song == int(status['song']):
+				self.state.update(elapsed=int(target))
+			else:
+				self.state.invalidate()
+		# else: before the first song, nowhere to go.
+
+	def throttle(self, name, send):
+		"""Calls send() right away, unless one was sent under name less than
+		mpd.repeat_delay seconds ago. Then only the last send() made in the
+		meantime is called once that time is up. A held key thus costs one
+		command per repeat_delay however fast it repeats."""
+		if name in self._held:
+			self._held[name][1] = send
+			return
+		send()
+		alarm = signals.alarm_in(float(config.mpd.repeat_delay),
+		                         lambda *_: self._release(name))
+		if alarm is not None: # Not without a main loop.
+			self._held[name] = [alarm, None]
+
+	def _release(self, name):
+		alarm, send = self._held.pop(name)
+		if send is not None:
+			self.throttle(name, send)
+
+class CommandBatch(object):
+	"""Queues MPD commands and sends them as a single command list.
+
+	with mpc.batch() as batch:
+		batch.next()
+		batch.seek(3, 10)
+	print batch.results # One result per command, in order.
+
+	Calling a command on the batch queues it and returns its index in results.
+	Everything is sent when the with block exits without an exception, or
+	when send() is called."""
+	results = None
+
+	def __init__(self, mpc):
+		self._mpc = mpc
+		self._commands = []
+
+	def __getattr__(self, command):
+		if command.startswith('_'):
+			raise AttributeError(command)
+		def queue(*args):
+			self._commands.append((command, args))
+			return len(self._commands) - 1
+		return queue
+
+	def __len__(self):
+		return len(self._commands)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.send()
+
+	def send(self):
+		self.results = self._mpc._send_batch(self._commands)
+		self._commands = []
+		return self.results
+
+class Request(object):
+	"""A command queued on a BackgroundClient."""
+	cancelled = False
+	result = None
+	error = None
+	_alarm = None
+
+	def __init__(self, command, args, callback, errback, stream=None):
+		self.command = command
+		self.args = args
+		self.stream = stream # Entries per partial result, if streamed.
+		self._callback = callback
+		self._errback = errback
+
+	def cancel(self):
+		"""Drops the request if it wasn't sent yet and ignores any result."""
+		self.cancelled = True
+		if self._alarm is not None:
+			signals.alarm_remove(self._alarm)
+			self._alarm = None
+
+	def _finish(self):
+		if self.cancelled:
+			return
+		self.cancel()
+		if self.error is not None:
+			self._errback(self.error)
+		elif self._callback is not None:
+			self._callback(self.result)
+
+	def _partial(self, entries):
+		if not self.cancelled and self._callback is not None:
+			self._callback(entries)
+
+	def _expire(self, *_):
+		self._alarm = None
+		self.error = mpd.ConnectionError('Timed out: %s' % self.command)
+		self._finish()
+
+class BackgroundClient(object):
+	"""Runs commands on a worker thread with a connection of its own.
+
+	Requests are sent in order. Finished ones are handed back through a pipe
+	watched by the main loop, so callbacks run on the UI thread like
+	everything else and never need locking.
+	Requests made before there is a main loop are answered once there is
+	one, but only time out if made after."""
+	_watched = False # Whether the main loop watches our pipe yet.
+
+	def __init__(self, mainmpc, name='urmpd-background'):
+		self._mpc = MPDClient()
+		self._mpc._host_port = mainmpc._host_port
+		self._mpc._timeout = mainmpc._timeout
+		self._timeout = mainmpc._timeout
+		self._pending = Queue.Queue()
+		self._finished = collections.deque()
+		self._read_fd, self._write_fd = os.pipe()
+		self._watch()
+
+		worker = threading.Thread(target=self._work, name=name)
+		worker.daemon = True
+		worker.start()
+
+	def _watch(self):
+		"""Has the main loop watch our pipe, as soon as there is one.
+		Whatever was handed back meanwhile waits in the pipe."""
+		if not self._watched:
+			self._watched = signals.watch_file(self._read_fd, self._deliver) is not None
+
+	def request(self, command, args, callback=None, errback=None, timeout=None,
+	            stream=None):
+		self._watch()
+		if errback is None:
+			errback = lambda e: signals.emit('user_notification', str(e))
+		request = Request(command, args, callback, errback, stream)
+		if timeout is None:
+			timeout = self._timeout
+		if timeout: # 0 waits as long as it takes.
+			request._alarm = signals.alarm_in(timeout, request._expire)
+		self._pending.put(request)
+		return request
+
+	def _work(self):
+		"""Worker thread: sends requests and queues them for delivery."""
+		while True:
+			request = self._pending.get()
+			if request.cancelled:
+				continue
+			try:
+				if request.stream:
+					self._stream(request)
+				else:
+					request.result = getattr(self._mpc, request.command)(*request.args)
+			except (socket.error, mpd.MPDError) as e:
+				request.error = e
+			except Exception as e:
+				# Reported like any other failure; this thread has to live
+				# on or every later request would wait forever. What is left
+				# of the response can't be trusted, so reconnect next time.
+				request.error = e
+				self._mpc._reset()
+			self._hand_back(request._finish)
+
+	def _stream(self, request):
+		"""Worker thread: hands back the result of request bit by bit.
+		The whole response is read even if request gets cancelled meanwhile,
+		the connection is of no use otherwise."""
+		self._mpc.iterate = True
+		try:
+			entries = []
+			for entry in getattr(self._mpc, request.command)(*request.args):
+				entries.append(entry)
+				if len(entries) >= request.stream:
+					if not request.cancelled:
+						self._hand_back(lambda e=entries: request._partial(e))
+					entries = []
+		except:
+			# Whatever is left of the response would be taken for the answer
+			# to the next request; start over on a new connection instead.
+			self._mpc._reset()
+			raise
+		finally:
+			self._mpc.iterate = False
+		if entries and not request.cancelled:
+			self._hand_back(lambda: request._partial(entries))
+		request.result = []
+
+	def _hand_back(self, call):
+		"""Worker thread: has call() run on the main loop."""
+		self._finished.append(call)
+		os.write(self._write_fd, '.')
+
+	def _deliver(self):
+		"""Main loop: runs callbacks of finished requests."""
+		os.read(self._read_fd, 4096)
+		while self._finished:
+			self._finished.popleft()()
 
 class Idler(MPDClient):
 	"""Idles for MPD events and reports them."""
-	_mainloop = None
-	def __init__(self, mainmpc, mainloop):
+	def __init__(self, mainmpc):
 		"""Steal credentials from main connection and starts idling."""
 		super(Idler, self).__init__()
-		self._mainloop = mainloop
 		self._host_port = mainmpc._host_port
+		self._timeout = mainmpc._timeout
+		self.state = mainmpc.state
 		self.send_idle()
 
 	def __call__(self):
@@ -158,10 +711,13 @@ class Idler(MPDClient):
 		events = self.fetch_idle()
 		self.send_idle()
 
-		# Emit events, force redraw if necessary
+		# Everyone reacting to this batch shares one fresh status.
+		self.state.invalidate()
+
+		# Emit events, redraw if necessary
 		redraw = False
 		for event in events:
 			redraw |= signals.emit('idle_'+event)
 		if redraw:
-			self._mainloop.draw_screen()
+			signals.redraw()
 
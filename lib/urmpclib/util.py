@@ -1,7 +1,53 @@
+import bisect
+import ctypes
+import ctypes.util
 import datetime
+import locale
+import os
+import re
+import time
+import unicodedata
 import urwid
 import signals
 
+def _monotonic():
+	"""Returns a clock that never jumps with the wall clock, for measuring
+	intervals: time.monotonic() where there is one, clock_gettime() with
+	CLOCK_MONOTONIC on Linux, else the elapsed time from os.times(). Only
+	if none of them works does it fall back to time.time()."""
+	try:
+		return time.monotonic
+	except AttributeError as e:
+		pass # Python 2.
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+	try:
+		librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+		                    use_errno=True)
+		clock_gettime = librt.clock_gettime
+	except (OSError, AttributeError) as e:
+		clock_gettime = None
+	if clock_gettime is not None:
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		CLOCK_MONOTONIC = 1 # From <linux/time.h>.
+		def monotonic():
+			t = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return t.tv_sec + t.tv_nsec * 1e-9
+		try:
+			monotonic()
+			return monotonic
+		except OSError as e:
+			pass
+	# Ticks since boot on Linux, 0 where elapsed time isn't available.
+	if os.times()[4] > 0:
+		return lambda: os.times()[4]
+	return time.time
+
+monotonic = _monotonic()
+
 class timedelta(datetime.timedelta):
 	"""Format times in a manner suitable for music.
 	If time is over a day it will be indicated by %s day(s).
@@ -33,6 +79,280 @@ class timedelta(datetime.timedelta):
 		return days + ':'.join(output)
 
 
+def ranges(positions):
+	"""Collapses positions into a list of half-open (start, end) runs.
+	ranges([5, 1, 2, 3, 7]) == [(1, 4), (5, 6), (7, 8)]"""
+	runs = []
+	for pos in sorted(positions):
+		if runs and runs[-1][1] == pos:
+			runs[-1][1] = pos + 1
+		else:
+			runs.append([pos, pos + 1])
+	return [tuple(run) for run in runs]
+
+
+_non_ascii = re.compile('[\x80-\xff]').search
+# Combining marks, which unicodedata.normalize('NFKD') splits accents into.
+_marks = re.compile(u'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]+')
+
+def collation_key(articles=(), fold_accents=False, use_locale=False):
+	"""Returns key(value) for sorting tag values, UTF-8 or unicode, by.
+	Case and any of the leading articles are ignored, e.g. ["the"], as are
+	accents if fold_accents. With use_locale, letters are ordered by the
+	rules of the locale's LC_COLLATE rather than by code point."""
+	prefixes = tuple(a.lower() if a.endswith("'") else a.lower() + ' '
+	                 for a in articles)
+	def key(value):
+		if isinstance(value, str) and not _non_ascii(value):
+			# Most values; ASCII str and unicode keys compare just fine.
+			text = value.lower()
+		else:
+			if isinstance(value, str):
+				value = value.decode('utf-8', 'replace')
+			text = value.lower()
+			if fold_accents:
+				text = _marks.sub(u'', unicodedata.normalize('NFKD', text))
+		if prefixes and text.startswith(prefixes):
+			for prefix in prefixes:
+				if text.startswith(prefix) and len(text) > len(prefix):
+					text = text[len(prefix):]
+					break
+		if use_locale:
+			if isinstance(text, unicode):
+				text = text.encode('utf-8')
+			return locale.strxfrm(text)
+		return text
+	return key
+
+class SortedValues(object):
+	"""Distinct values in order of key(value), to stand in for a walker's
+	list of items.
+
+	Keys are made once per value, and index() bisects by the value's key
+	instead of scanning. Assigning to items[:] updates in place: values
+	staying keep their keys, and a few changes are inserted and deleted
+	where they belong; many are sorted on their own and merged in, which
+	sorting two sorted runs does in linear time.
+	Supports the parts of the list protocol walkers use."""
+
+	def __init__(self, key, values=()):
+		self._key = key
+		self._keys = {} # {value: key}
+		self._values = [] # Sorted by key; equal keys in no particular order.
+		self._order = [] # Their keys, to bisect.
+		self.update(values)
+
+	def update(self, values):
+		"""Makes values, in any order, the new contents.
+		Returns whether anything changed."""
+		values = set(values)
+		keys = self._keys
+		if keys.viewkeys() == values:
+			return False
+		removed = keys.viewkeys() - values
+		added = values - keys.viewkeys()
+		few = (len(removed) + len(added)) * 32 < len(self._values)
+		if few:
+			for value in removed:
+				pos = self.index(value)
+				del self._values[pos]
+				del self._order[pos]
+		for value in removed:
+			del keys[value]
+		key = self._key
+		for value in added:
+			keys[value] = key(value)
+		if few:
+			for value in added:
+				pos = bisect.bisect_right(self._order, keys[value])
+				self._values.insert(pos, value)
+				self._order.insert(pos, keys[value])
+		else:
+			kept = self._values
+			if removed:
+				kept = [value for value in kept if value not in removed]
+			added = sorted(added, key=keys.__getitem__)
+			if kept:
+				kept.extend(added)
+				kept.sort(key=keys.__getitem__)
+			else:
+				kept = added
+			self._values = kept
+			self._order = map(keys.__getitem__, kept)
+		return True
+
+	def key_of(self, pos):
+		"""The sort key of the value at pos."""
+		return self._order[pos]
+
+	def find(self, text):
+		"""Position of the first value sorting at or after text, i.e. the
+		first one starting with it if any does."""
+		return bisect.bisect_left(self._order, self._key(text))
+
+	def index(self, value):
+		key = self._keys.get(value)
+		if key is not None:
+			pos = bisect.bisect_left(self._order, key)
+			while pos < len(self._order) and self._order[pos] == key:
+				if self._values[pos] == value:
+					return pos
+				pos += 1
+		raise ValueError(value)
+
+	def __contains__(self, value):
+		return value in self._keys
+
+	def __len__(self):
+		return len(self._values)
+
+	def __iter__(self):
+		return iter(self._values)
+
+	def __getitem__(self, pos):
+		return self._values[pos]
+
+	def __setitem__(self, pos, values):
+		if pos != slice(None):
+			raise TypeError('only items[:] can be assigned to')
+		self.update(values)
+
+	def __delitem__(self, pos):
+		if pos != slice(None):
+			raise TypeError('only items[:] can be deleted')
+		self.update(())
+
+def increasing(sequence):
+	"""Indices of a longest strictly increasing subsequence of sequence."""
+	tails = [] # tails[k]: index ending the best run of length k + 1.
+	before = [None] * len(sequence)
+	for i, value in enumerate(sequence):
+		low, high = 0, len(tails)
+		while low < high:
+			middle = (low + high) // 2
+			if sequence[tails[middle]] < value:
+				low = middle + 1
+			else:
+				high = middle
+		if low > 0:
+			before[i] = tails[low - 1]
+		if low == len(tails):
+			tails.append(i)
+		else:
+			tails[low] = i
+	run = []
+	i = tails[-1] if tails else None
+	while i is not None:
+		run.append(i)
+		i = before[i]
+	run.reverse()
+	return run
+
+def move_plan(current, target):
+	"""Returns [(item, to)] such that moving each item to position to, one
+	after the other as MPD's moveid does, turns current into target.
+	Both hold the same unique items.
+
+	Items along a longest increasing run of target positions stay where they
+	are; that makes for the fewest moves possible. Every other item goes
+	right after the one preceding it in target, in target order."""
+	where = dict((item, pos) for pos, item in enumerate(target))
+	order = [where[item] for item in current]
+	stay = set(current[i] for i in increasing(order))
+	origin = dict((item, pos) for pos, item in enumerate(current))
+
+	# An item's place never depends on anything but this label: (position
+	# it started at, 0) until moved, then (that of the item heading its
+	# run of moved items, place in that run). -1 heads a run at the start.
+	labels = {}
+	head, count = -1, 0
+	for item in target:
+		if item in stay:
+			head, count = origin[item], 0
+		else:
+			count += 1
+			labels[item] = head, count
+	universe = sorted(set([(pos, 0) for pos in xrange(len(current))] +
+	                      labels.values()))
+	rank = dict((label, i + 1) for i, label in enumerate(universe))
+
+	# Fenwick tree counting items at each label, to find positions quickly.
+	tree = [0] * (len(universe) + 1)
+	def add(i, delta):
+		while i < len(tree):
+			tree[i] += delta
+			i += i & -i
+	def before(i):
+		total = 0
+		i -= 1
+		while i > 0:
+			total += tree[i]
+			i -= i & -i
+		return total
+	for pos in xrange(len(current)):
+		add(rank[pos, 0], 1)
+
+	moves = []
+	for item in target:
+		if item in stay:
+			continue
+		add(rank[origin[item], 0], -1)
+		label = rank[labels[item]]
+		moves.append((item, before(label)))
+		add(label, 1)
+	return moves
+
+class MainLoop(urwid.MainLoop):
+	"""Draws the screen at most once per event loop iteration, and no more
+	than max_fps times a second (None or 0 for no limit).
+
+	draw_screen() only asks for a draw. urwid draws anyway whenever the event
+	loop goes idle, after any input, alarm or MPD event, so that is where
+	all requests made in between are served at once. A frame that renders
+	to the very canvas already on screen is not sent again.
+	requested counts draw_screen() calls and performed the frames sent, which
+	tells how much a slow terminal link is spared; the stats key shows them."""
+	requested = 0
+	performed = 0
+	_drawn = None # (size, canvas) on screen.
+	_drawn_at = 0.0
+	_alarm = None
+
+	def __init__(self, *args, **kwargs):
+		self.max_fps = kwargs.pop('max_fps', None)
+		super(MainLoop, self).__init__(*args, **kwargs)
+
+	def draw_screen(self):
+		self.requested += 1
+
+	def entering_idle(self):
+		if not self.screen.started:
+			return
+		if self.max_fps:
+			wait = self._drawn_at + 1.0 / self.max_fps - monotonic()
+			if wait > 0:
+				# The alarm going off gets us back here.
+				if self._alarm is None:
+					self._alarm = self.set_alarm_in(wait, self._frame_due)
+				return
+		self._draw()
+
+	def _frame_due(self, *_):
+		self._alarm = None
+
+	def _draw(self):
+		if not self.screen_size:
+			self.screen_size = self.screen.get_cols_rows()
+		canvas = self._topmost_widget.render(self.screen_size, focus=True)
+		# Widgets invalidate their cached canvases when they change, so the
+		# same canvas means nothing changed.
+		if self._drawn == (self.screen_size, canvas):
+			return
+		self.screen.draw_screen(self.screen_size, canvas)
+		self._drawn = self.screen_size, canvas
+		self._drawn_at = monotonic()
+		self.performed += 1
+
 class VDivider(urwid.BoxWidget):
 	def __init__(self, div_char=' ', top=0, bottom=0):
 		super(VDivider, self).__init__()
@@ -52,7 +372,8 @@ class VDivider(urwid.BoxWidget):
 
 class WidgetMux(urwid.WidgetWrap):
 	"""Holds several widgets in one place and allows switching between them.
-	Similar to GNU screen or a tabbed interface but with no defined UI."""
+	Similar to GNU screen or a tabbed interface but with no defined UI.
+	A widget with a shown() method has it called whenever it is switched to."""
 	def __init__(self, widget_dict, default):
 		"""widget_dict: Mapping type (ie dict) of {name: Widget} pairs.
 		default: name of Widget to initially use.
@@ -65,6 +386,8 @@ class WidgetMux(urwid.WidgetWrap):
 		target = self.widget_dict[name]
 		if self._w is not target:
 			self._w = target
+			if hasattr(target, 'shown'):
+				target.shown()
 		else:
 			signals.redraw()
 
@@ -73,3 +396,53 @@ class WidgetMux(urwid.WidgetWrap):
 		name = [k for k, v in self.widget_dict.items() if v is self._w] + [None]
 		return name[0]
 
+if __name__ == '__main__':
+	# Artist column reload benchmark: python util.py [artists]
+	import sys
+	import time
+	import random
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	random.seed(0)
+	letters = u'abcdefghijklmnopqrstuvwxyz'
+	accented = u'\xe9\xe8\xf6\xfc\xe5\xf1' # One name in ten has some.
+	def name():
+		words = [u''.join(random.choice(letters) for _ in xrange(random.randint(2, 8)))
+		         for _ in xrange(random.randint(1, 3))]
+		if random.random() < 0.1:
+			words[0] = random.choice(accented) + words[0]
+		if random.random() < 0.1:
+			words.insert(0, u'the')
+		return u' '.join(words).title().encode('utf-8')
+	artists = list(set(name() for _ in xrange(count)))
+	changed = artists[100:] + [name() for _ in xrange(100)] # 100 gone, 100 new.
+
+	def old(artist):
+		artist = artist.lower()
+		if artist.startswith('the '):
+			return artist[4:]
+		return artist
+	def timed(what, run, times=5):
+		best = min(timeit(run) for _ in xrange(times))
+		print '%-44s %8.2f ms' % (what, best * 1000)
+	def timeit(run):
+		start = time.time()
+		run()
+		return time.time() - start
+
+	print '%d artists' % len(artists)
+	items = sorted(artists, key=old)
+	focus = items[-1] # Where a linear search takes longest.
+	timed('before: sort on reload', lambda: sorted(changed, key=old))
+	timed('before: relocate focus with list.index', lambda: items.index(focus))
+	key = collation_key(['the'], True, False)
+	timed('initial load, folded keys', lambda: SortedValues(key, artists))
+	if locale.getlocale(locale.LC_COLLATE)[0]:
+		timed('initial load, folded keys, locale collation',
+		      lambda: SortedValues(collation_key(['the'], True, True), artists))
+	values = SortedValues(key, artists)
+	timed('reload, nothing changed', lambda: values.update(artists))
+	def reload():
+		values.update(changed)
+		values.update(artists)
+	timed('reload, 100 gone and 100 new (x2)', reload)
+	timed('relocate focus with index()', lambda: values.index(focus))
@@ -10,6 +10,7 @@ setup(name='urmpc',
 	url='http://github.com/sporkexec/urmpc',
 	packages=['urmpclib'],
 	package_dir={'': 'lib'},
+	package_data={'urmpclib': ['urmpc.conf.example']},
 	scripts=['bin/urmpc'],
 	classifiers=[
 		'Development Status :: 3 - Alpha',